@@ -0,0 +1,210 @@
+# adaptive.py
+#
+# Copyright 2021 Purism, SPC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, Gst
+
+from . import quality
+
+class AdaptivePlayer:
+
+    # plays a video rendition and an audio rendition (adaptiveFormats)
+    # from their own urls in one pipeline, and moves to another video
+    # rendition as the measured bandwidth changes. It has the parts of
+    # playbin that ResultsBox uses, so either can be its player.
+
+    # seconds between bandwidth checks while playing
+    check_interval = 5
+    # seconds a rendition plays before it may be switched again
+    min_switch_interval = 15
+
+    def __init__(self, **kwargs):
+        self.video_sink = kwargs.get('video_sink', None)
+        # adaptive video formats to pick from, and the audio format
+        self.video_formats = kwargs.get('video_formats', [])
+        self.audio_format = kwargs.get('audio_format', None)
+        self.max_height = kwargs.get('max_height', None)
+        # called as error_cb(player) if the pipeline fails
+        self.error_cb = kwargs.get('error_cb', None)
+
+        self.bandwidth = quality.get_default()
+
+        self.pipeline = Gst.Pipeline.new(None)
+
+        # video: source -> queue -> videoconvert -> video sink
+        self.video_queue = Gst.ElementFactory.make("queue")
+        video_convert = Gst.ElementFactory.make("videoconvert")
+        self.add_chain([ self.video_queue, video_convert, self.video_sink ])
+
+        # audio: source -> queue -> convert -> resample -> volume -> sink
+        self.audio_queue = Gst.ElementFactory.make("queue")
+        self.volume = Gst.ElementFactory.make("volume")
+        self.add_chain([ self.audio_queue,
+                         Gst.ElementFactory.make("audioconvert"),
+                         Gst.ElementFactory.make("audioresample"),
+                         self.volume,
+                         Gst.ElementFactory.make("autoaudiosink") ])
+
+        self.audio_source = self.add_source(self.audio_format['url'], self.audio_queue)
+
+        self.video_format = self.pick_video_format()
+        self.video_source = self.add_source(self.video_format['url'], self.video_queue)
+        self.switched = GLib.get_monotonic_time()
+        # position to resume from once a switched source is linked
+        self.switch_position = None
+
+        self.check_id = 0
+        self.failed = False
+
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_signal_watch()
+        self.bus_id = self.bus.connect("message::error", self.on_error)
+
+    def add_chain(self, elements):
+        for element in elements:
+            self.pipeline.add(element)
+        for upstream, downstream in zip(elements, elements[1:]):
+            upstream.link(downstream)
+
+    def add_source(self, uri, queue):
+        source = Gst.ElementFactory.make("uridecodebin")
+        source.set_property("uri", uri)
+        source.connect("pad-added", self.on_pad_added, queue)
+        self.pipeline.add(source)
+        return source
+
+    def on_pad_added(self, source, pad, queue):
+        # each rendition carries a single stream
+        sink_pad = queue.get_static_pad("sink")
+        if sink_pad.is_linked():
+            return
+
+        pad.link(sink_pad)
+        if source == self.video_source and self.switch_position is not None:
+            GLib.idle_add(self.resume_switch)
+
+    def get_audio_bitrate(self):
+        return quality.FormatSelector().get_bitrate(self.audio_format) or 0
+
+    def pick_video_format(self):
+        selector = quality.FormatSelector(
+            bandwidth = self.bandwidth.get_estimate(),
+            max_height = self.max_height)
+        # the audio rendition shares the link
+        return selector.pick_video(self.video_formats, self.get_audio_bitrate())
+
+    def check_bandwidth(self):
+        now = GLib.get_monotonic_time()
+        if (self.switch_position is not None or
+                now - self.switched < self.min_switch_interval * GLib.USEC_PER_SEC):
+            return True
+
+        video_format = self.pick_video_format()
+        if video_format and video_format['url'] != self.video_format['url']:
+            self.switch_video(video_format)
+        return True
+
+    def switch_video(self, video_format):
+        success, position = self.pipeline.query_position(Gst.Format.TIME)
+        if not success:
+            return False
+
+        # block the old rendition before it is taken out, so it
+        # does not push into an unlinked pad (a not-linked error)
+        sink_pad = self.video_queue.get_static_pad("sink")
+        peer = sink_pad.get_peer()
+        if not peer:
+            return False
+
+        self.switch_position = position
+        self.switched = GLib.get_monotonic_time()
+        self.video_format = video_format
+        peer.add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM,
+                       self.video_blocked, self.video_source)
+
+    def video_blocked(self, pad, info, source):
+        # streaming thread, the swap itself happens on the main loop
+        GLib.idle_add(self.swap_video_source, pad, source)
+        return Gst.PadProbeReturn.OK
+
+    def swap_video_source(self, pad, source):
+        if source != self.video_source:
+            return False
+
+        pad.unlink(self.video_queue.get_static_pad("sink"))
+        source.set_state(Gst.State.NULL)
+        self.pipeline.remove(source)
+
+        self.video_source = self.add_source(self.video_format['url'], self.video_queue)
+        self.video_source.sync_state_with_parent()
+        return False
+
+    def resume_switch(self):
+        # the new rendition starts from the next keyframe at the old
+        # position, the audio follows it so both stay in sync
+        position = self.switch_position
+        self.switch_position = None
+        if position is not None:
+            self.pipeline.seek_simple(Gst.Format.TIME,
+                Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT |
+                Gst.SeekFlags.SNAP_AFTER, position)
+        return False
+
+    def on_error(self, bus, message):
+        if self.failed:
+            return
+        self.failed = True
+        if self.error_cb:
+            self.error_cb(self)
+
+    def release(self):
+        # give the video sink back, so another player can use it
+        self.set_state(Gst.State.NULL)
+        self.bus.disconnect(self.bus_id)
+        self.bus.remove_signal_watch()
+        self.pipeline.remove(self.video_sink)
+
+    # playbin compatible
+
+    def set_state(self, state):
+        if state == Gst.State.PLAYING:
+            if not self.check_id:
+                self.check_id = GLib.timeout_add_seconds(self.check_interval,
+                    self.check_bandwidth)
+        elif self.check_id:
+            GLib.source_remove(self.check_id)
+            self.check_id = 0
+        return self.pipeline.set_state(state)
+
+    def set_property(self, name, value):
+        if name == "volume":
+            self.volume.set_property("volume", value)
+        else:
+            self.pipeline.set_property(name, value)
+
+    def query(self, query):
+        return self.pipeline.query(query)
+
+    def query_position(self, format):
+        return self.pipeline.query_position(format)
+
+    def query_duration(self, format):
+        return self.pipeline.query_duration(format)
+
+    def seek_simple(self, format, flags, position):
+        return self.pipeline.seek_simple(format, flags, position)
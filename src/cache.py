@@ -0,0 +1,127 @@
+# cache.py
+#
+# Copyright 2021 Purism, SPC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib
+
+from collections import OrderedDict
+import json
+import os
+
+class ResponseCache:
+
+    def __init__(self, **kwargs):
+        # entries kept in memory, least recently used are evicted first
+        self.max_entries = kwargs.get('max_entries', 64)
+        # seconds an entry is served before it is refetched,
+        # 0 disables the cache
+        self.ttl = kwargs.get('ttl', 600)
+        # optional directory for a second, on-disk tier
+        self.disk_dir = kwargs.get('disk_dir', None)
+        self.disk_max_entries = kwargs.get('disk_max_entries', 256)
+
+        # key -> { 'time', 'instance', 'body' }
+        self.entries = OrderedDict()
+
+        if not self.ttl:
+            self.disk_dir = None
+
+        if self.disk_dir:
+            try:
+                os.makedirs(self.disk_dir, exist_ok = True)
+            except:
+                self.disk_dir = None
+
+    def now(self):
+        return GLib.get_real_time() / GLib.USEC_PER_SEC
+
+    def is_fresh(self, entry):
+        return self.now() - entry['time'] <= self.ttl
+
+    def get_disk_path(self, key):
+        name = GLib.compute_checksum_for_string(GLib.ChecksumType.SHA1, key, -1)
+        return os.path.join(self.disk_dir, f"{name}.json")
+
+    def get(self, key):
+        if not self.ttl:
+            return None
+
+        entry = self.entries.get(key)
+        if entry:
+            if self.is_fresh(entry):
+                self.entries.move_to_end(key)
+                return entry
+            del self.entries[key]
+
+        entry = self.get_disk(key)
+        if entry:
+            self.put_memory(key, entry)
+        return entry
+
+    def put(self, key, instance, body):
+        if not self.ttl:
+            return False
+
+        entry = { 'time': self.now(),
+                  'instance': instance,
+                  'body': body }
+        self.put_memory(key, entry)
+        self.put_disk(key, entry)
+
+    def put_memory(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+    def get_disk(self, key):
+        if not self.disk_dir:
+            return None
+
+        try:
+            with open(self.get_disk_path(key)) as file:
+                entry = json.load(file)
+        except:
+            return None
+
+        if entry.get('key') != key or not self.is_fresh(entry):
+            return None
+        return entry
+
+    def put_disk(self, key, entry):
+        if not self.disk_dir:
+            return False
+
+        try:
+            with open(self.get_disk_path(key), 'w') as file:
+                json.dump(dict(entry, key = key), file)
+        except:
+            return False
+
+        self.prune_disk()
+
+    def prune_disk(self):
+        try:
+            paths = [os.path.join(self.disk_dir, name)
+                     for name in os.listdir(self.disk_dir)]
+            if len(paths) <= self.disk_max_entries:
+                return
+            # least recently written first
+            paths.sort(key = os.path.getmtime)
+            for path in paths[:len(paths) - self.disk_max_entries]:
+                os.remove(path)
+        except:
+            pass
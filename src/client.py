@@ -0,0 +1,221 @@
+# client.py
+#
+# Copyright 2021 Purism, SPC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gi
+gi.require_version('Soup', '2.4')
+from gi.repository import GLib, Soup
+
+# request priority classes, most urgent first
+# results on screen (and whatever the user is waiting on)
+PRIORITY_VISIBLE = 0
+# results just outside the viewport
+PRIORITY_NEAR = 1
+# pages and results fetched ahead of the scroll position
+PRIORITY_PREFETCH = 2
+# instance discovery and health checks
+PRIORITY_PROBE = 3
+
+class Client:
+
+    # connection pool limits, one session is shared by the whole app
+    # so keep-alive connections to an instance are reused across requests
+    max_conns = 48
+    max_conns_per_host = 6
+    # seconds an unused keep-alive connection is held open
+    idle_timeout = 60
+    # seconds a request may take before it is cancelled
+    default_timeout = 5
+    # requests that are safe to share between callers
+    coalesce_methods = [ 'GET', 'HEAD' ]
+
+    # requests handed to the session at once, the rest wait their turn
+    # so a burst of offscreen work cannot delay what is on screen
+    max_running = 16
+    # requests of each priority class handed to the session at once
+    priority_limits = { PRIORITY_VISIBLE: 12,
+                        PRIORITY_NEAR: 6,
+                        PRIORITY_PREFETCH: 3,
+                        PRIORITY_PROBE: 8 }
+
+    def __init__(self):
+        self.session = Soup.Session.new()
+        self.session.set_property("max-conns", self.max_conns)
+        self.session.set_property("max-conns-per-host", self.max_conns_per_host)
+        self.session.set_property("idle-timeout", self.idle_timeout)
+
+        # message -> timeout source id
+        self.timeouts = {}
+        # message -> monotonic time it was handed to the session
+        self.started = {}
+
+        # (method, uri) -> message of the identical request in flight
+        self.pending = {}
+        # message -> [(callback, user_data)] waiting on its response
+        self.waiters = {}
+
+        # called as observer(message, elapsed_seconds) for every
+        # finished request, used to measure instances
+        self.observers = []
+
+        # message -> { 'key', 'priority', 'timeout', 'slot' }, slot is
+        # the class the message is counted against once it is running
+        self.requests = {}
+        # priority -> messages not handed to the session yet, oldest first
+        self.waiting = { priority: [] for priority in self.priority_limits }
+        # priority -> messages of that class handed to the session
+        self.running = { priority: 0 for priority in self.priority_limits }
+
+    def queue(self, method, uri, callback, user_data = None, timeout = None,
+              priority = PRIORITY_VISIBLE):
+        # callback is called as callback(session, message, user_data)
+        # just like a Soup.Session.queue_message callback
+        key = (method, uri)
+        if key in self.pending:
+            # the same request is already on its way, wait for its response
+            message = self.pending[key]
+            self.waiters[message].append((callback, user_data))
+            if priority < self.requests[message]['priority']:
+                self.set_priority(message, priority)
+            return message
+
+        message = Soup.Message.new(method, uri)
+        if not message:
+            # malformed uri, report it as a failed message
+            message = Soup.Message.new(method, "http://invalid/")
+            message.set_status(Soup.Status.MALFORMED)
+            GLib.idle_add(self.idle_fail_cb, message, callback, user_data)
+            return message
+
+        if timeout is None:
+            timeout = self.default_timeout
+
+        self.waiters[message] = [(callback, user_data)]
+        if method in self.coalesce_methods:
+            self.pending[key] = message
+        self.requests[message] = { 'key': key,
+                                   'priority': priority,
+                                   'timeout': timeout,
+                                   'slot': None }
+        self.waiting[priority].append(message)
+        self.dispatch()
+        return message
+
+    def dispatch(self):
+        # hand waiting requests to the session, most urgent class first
+        running = sum(self.running.values())
+        for priority in sorted(self.waiting):
+            waiting = self.waiting[priority]
+            while (waiting and running < self.max_running and
+                   self.running[priority] < self.priority_limits[priority]):
+                self.send(waiting.pop(0))
+                running += 1
+
+    def send(self, message):
+        request = self.requests[message]
+        request['slot'] = request['priority']
+        self.running[request['slot']] += 1
+
+        # the timeout only covers the network, not the wait for a slot
+        self.timeouts[message] = GLib.timeout_add_seconds(request['timeout'],
+            self.timeout_cb, message)
+        self.started[message] = GLib.get_monotonic_time()
+        self.session.queue_message(message, self.queue_cb, None)
+
+    def set_priority(self, message, priority):
+        # re-rank a request, e.g. when its result scrolls into view,
+        # a running request keeps its slot
+        request = self.requests.get(message)
+        if not request or request['priority'] == priority:
+            return False
+
+        if request['slot'] is None:
+            self.waiting[request['priority']].remove(message)
+            self.waiting[priority].append(message)
+        request['priority'] = priority
+        self.dispatch()
+
+    def queue_cb(self, session, message, user_data):
+        request = self.requests.pop(message, None)
+        if request:
+            if self.pending.get(request['key']) == message:
+                del self.pending[request['key']]
+            if request['slot'] is not None:
+                self.running[request['slot']] -= 1
+        waiters = self.waiters.pop(message, [])
+
+        timeout_id = self.timeouts.pop(message, None)
+        if timeout_id:
+            GLib.source_remove(timeout_id)
+
+        started = self.started.pop(message, None)
+        if started:
+            elapsed = (GLib.get_monotonic_time() - started) / GLib.USEC_PER_SEC
+            for observer in self.observers:
+                observer(message, elapsed)
+
+        # one response fans out to every caller of the request
+        for callback, user_data in waiters:
+            callback(session, message, user_data)
+
+        self.dispatch()
+
+    def idle_fail_cb(self, message, callback, user_data):
+        callback(self.session, message, user_data)
+        return False
+
+    def timeout_cb(self, message):
+        # the source is removed by returning False, forget it
+        # so queue_cb does not try to remove it again
+        self.timeouts.pop(message, None)
+        self.session.cancel_message(message, Soup.Status.IO_ERROR)
+        return False
+
+    def is_pending(self, message):
+        return message in self.waiters
+
+    def cancel(self, message, owner = None):
+        # with an owner only the callbacks bound to it are detached (and
+        # not called back), other callers sharing the request keep it
+        waiters = self.waiters.get(message)
+        if waiters is None:
+            # already finished
+            return
+
+        if owner:
+            waiters[:] = [waiter for waiter in waiters
+                          if getattr(waiter[0], '__self__', None) is not owner]
+            if waiters:
+                return
+
+        request = self.requests.get(message)
+        if request and request['slot'] is None:
+            # never handed to the session, finish it here
+            self.waiting[request['priority']].remove(message)
+            message.set_status(Soup.Status.CANCELLED)
+            self.queue_cb(self.session, message, None)
+            return
+
+        self.session.cancel_message(message, Soup.Status.CANCELLED)
+
+# one client (and so one Soup.Session) per process
+default_client = None
+
+def get_default():
+    global default_client
+    if not default_client:
+        default_client = Client()
+    return default_client
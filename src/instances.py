@@ -15,31 +15,75 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import gi
-gi.require_version('Soup', '2.4')
-from gi.repository import Soup
+from gi.repository import GLib
 
 import json
 
+from . import client
+
 class Instances:
 
+    # directory of public instances, sorted by their health
+    directory_uri = "https://api.invidious.io/instances.json?sort_by=health"
+    # probed after the directory instances as a backup
+    backup_instances = [ 'https://iteroni.com',
+                         'https://tube.connect.cafe' ]
+
+    user_data_dir = GLib.get_user_data_dir()
+    cache_file = f"{user_data_dir}/instances.json"
+
+    # seconds a cached strong instance is trusted before it
+    # has to go through the full probe again
+    cache_ttl = 60 * 60 * 24
+
+    # probe chains allowed to run at the same time
+    probe_concurrency = 8
+    # stop probing once this many strong instances are confirmed
+    probe_target = 5
+
+    # background health monitor, in seconds: how often it looks for
+    # instances that are due, the normal re-probe interval and the
+    # longest backoff for an instance that keeps failing
+    monitor_tick = 30
+    monitor_interval = 60 * 5
+    monitor_max_interval = 60 * 60
+
     def __init__(self, **kwargs):
         self.app_window = kwargs.get('app_window', None)
 
-    def get_strong_instances(self):
+        self.client = client.get_default()
+
+        # uri -> { 'last_success', 'latency', 'failure' }
+        self.cache_json = { 'instances': {} }
+        self.cache_write_id = 0
+        self.get_cache_json()
+
+        # instance uris waiting for a probe chain
+        self.probe_queue = []
+        # uri -> message of the probe stage in flight
+        self.probe_messages = {}
+        self.probe_confirmed = 0
+        self.probe_target_count = None
+
+        # uri -> { 'failures', 'next_check' } for the health monitor
+        self.monitor_schedule = {}
+        self.monitor_id = 0
+
+    def get_strong_instances(self, use_cache = True):
         # this processes a series of tests
         # 1. check if instance api and search are valid
         # 2. check if the instance returns a valid video page result
         # 3. check if the instance returns valid video url
         # then sets it as a strong instance
 
-        # get urls of instances from api.invidious.io
-        uri = f"https://api.invidious.io/instances.json?sort_by=health"
+        # previously strong instances can be used right away,
+        # they are revalidated in the background
+        if use_cache and self.use_cached_instances():
+            return
 
-        session = Soup.Session.new()
-        session.set_property("timeout", 10)
-        message = Soup.Message.new("GET", uri)
-        session.queue_message(message, self.get_strong_instances_cb, None)
+        # get urls of instances from api.invidious.io
+        self.client.queue("GET", self.directory_uri,
+            self.get_strong_instances_cb, None, timeout = 10)
 
     def get_strong_instances_cb(self, session, results, user_data):
         if results.status_code != 200:
@@ -54,17 +98,193 @@ class Instances:
                     "Instances are malformed, cannot complete search.")
             return False
 
+        instance_uris = []
         for instance in instances_json:
             instance_uri = instance[1]['uri'].rstrip('/')
 
             # remove non http gettable urls
             if (not instance_uri.endswith('.onion') and
                     not instance_uri.endswith('.i2p')):
-                self.check_query_api_valid(instance_uri)
+                instance_uris.append(instance_uri)
 
         # add a backup
-        self.check_query_api_valid('https://iteroni.com')
-        self.check_query_api_valid('https://tube.connect.cafe')
+        instance_uris.extend(self.backup_instances)
+
+        self.queue_probes(instance_uris, self.probe_target)
+
+    def queue_probes(self, uris, target = None):
+        # a new probe run replaces whatever is still running
+        self.cancel_probes()
+
+        for uri in uris:
+            if uri not in self.probe_queue:
+                self.probe_queue.append(uri)
+        self.probe_confirmed = 0
+        self.probe_target_count = target
+
+        self.run_probes()
+
+    def run_probes(self):
+        while self.probe_queue and len(self.probe_messages) < self.probe_concurrency:
+            self.check_query_api_valid(self.probe_queue.pop(0))
+
+    def cancel_probes(self):
+        self.probe_queue = []
+
+        # forget the messages first, so their (cancelled)
+        # callbacks are ignored as stale
+        messages = list(self.probe_messages.values())
+        self.probe_messages = {}
+        for message in messages:
+            self.client.cancel(message, self)
+
+    def is_current_probe(self, uri, message):
+        return self.probe_messages.get(uri) == message
+
+    def probe_finished(self, uri):
+        self.probe_messages.pop(uri, None)
+        self.run_probes()
+
+    def start_monitor(self):
+        if not self.monitor_id:
+            self.monitor_id = GLib.timeout_add_seconds(self.monitor_tick,
+                self.monitor_cb)
+
+    def monitor_cb(self):
+        # leave running probe runs (startup, reload) alone
+        if self.probe_queue or self.probe_messages:
+            return True
+
+        now = GLib.get_monotonic_time() / GLib.USEC_PER_SEC
+        due = []
+        for uri, health in self.cache_json['instances'].items():
+            # only instances that have been strong at some point
+            if not health['last_success']:
+                continue
+
+            schedule = self.monitor_schedule.get(uri)
+            if not schedule or schedule['next_check'] <= now:
+                due.append(uri)
+
+        if due:
+            self.queue_probes(due)
+
+        return True
+
+    def schedule_check(self, uri, healthy):
+        schedule = self.monitor_schedule.setdefault(uri, { 'failures': 0,
+                                                           'next_check': 0 })
+        if healthy:
+            schedule['failures'] = 0
+        else:
+            schedule['failures'] += 1
+
+        # exponential backoff for failing instances, with jitter
+        # so instances probed together do not stay in lockstep
+        interval = min(self.monitor_interval * 2 ** schedule['failures'],
+                       self.monitor_max_interval)
+        interval *= GLib.random_double_range(0.8, 1.2)
+
+        now = GLib.get_monotonic_time() / GLib.USEC_PER_SEC
+        schedule['next_check'] = now + interval
+
+    def get_cache_json(self):
+        try:
+            with open(self.cache_file) as file:
+                cache_json = json.load(file)
+        except:
+            return False
+
+        # an older format or a partial write keeps the empty default
+        if not isinstance(cache_json, dict) or not isinstance(cache_json.get('instances'), dict):
+            return False
+
+        health_keys = [ 'last_success', 'latency', 'failure' ]
+        cache_json['instances'] = { uri: health for uri, health
+                                    in cache_json['instances'].items()
+                                    if isinstance(health, dict) and
+                                    all(key in health for key in health_keys) }
+        self.cache_json = cache_json
+        return True
+
+    def write_cache_json(self):
+        self.cache_write_id = 0
+        try:
+            with open(self.cache_file, 'w') as file:
+                json.dump(self.cache_json, file)
+        except:
+            pass
+        return False
+
+    def queue_cache_write(self):
+        # probes finish in bursts, write them out together
+        if not self.cache_write_id:
+            self.cache_write_id = GLib.timeout_add_seconds(2, self.write_cache_json)
+
+    def use_cached_instances(self):
+        now = GLib.get_real_time() / GLib.USEC_PER_SEC
+        cached = []
+        for uri, health in self.cache_json['instances'].items():
+            if health['failure'] or not health['last_success']:
+                continue
+            if now - health['last_success'] <= self.cache_ttl:
+                cached.append(uri)
+
+        if not cached:
+            return False
+
+        # seed the pool ranking with the cached latency
+        for uri in cached:
+            self.add_strong_instance(uri, self.cache_json['instances'][uri]['latency'])
+
+        # revalidate cached instances, failures are dropped again
+        self.queue_probes(cached)
+
+        return True
+
+    def add_strong_instance(self, uri, latency = None):
+        self.app_window.strong_instances.add(uri, latency)
+        self.app_window.strong_instance_found()
+        self.app_window.status_icon.set_property('icon-name', 'object-select-symbolic')
+
+    def probe_success(self, uri):
+        now = GLib.get_real_time() / GLib.USEC_PER_SEC
+        # every probe stage is timed by the pool as it finishes
+        latency = self.app_window.strong_instances.get_latency(uri)
+
+        self.cache_json['instances'][uri] = { 'last_success': now,
+                                              'latency': latency,
+                                              'failure': None }
+        self.queue_cache_write()
+        self.schedule_check(uri, True)
+
+        self.probe_confirmed += 1
+        if self.probe_target_count and self.probe_confirmed >= self.probe_target_count:
+            # enough strong instances, leave the bandwidth to the user
+            self.cancel_probes()
+        else:
+            self.probe_finished(uri)
+
+    def probe_failure(self, uri, reason):
+        self.probe_finished(uri)
+
+        health = self.cache_json['instances'].get(uri, { 'last_success': None,
+                                                         'latency': None })
+        health['failure'] = reason
+        self.cache_json['instances'][uri] = health
+        self.queue_cache_write()
+        self.schedule_check(uri, False)
+
+        # a cached instance that no longer passes is not strong anymore
+        if uri in self.app_window.strong_instances:
+            self.app_window.strong_instances.remove(uri)
+
+            # every cached instance went bad, fall back to the full probe
+            if (not self.app_window.strong_instances and
+                    not self.probe_queue and not self.probe_messages):
+                self.get_strong_instances(use_cache = False)
+
+        return False
 
     # check the instance can run a query on the API
     def check_query_api_valid(self, uri):
@@ -72,25 +292,30 @@ class Instances:
         # /api/v1/search?q=Librem%205;fields=type
         search_uri = f"{uri}/api/v1/search?q=Librem%205;fields=type"
         #print(search_uri)
-        session = Soup.Session.new()
-        session.set_property("timeout", 2)
-        message = Soup.Message.new("GET", search_uri)
-        session.queue_message(message, self.check_query_valid_cb, uri)
+        self.app_window.strong_instances.watch(uri)
+        self.probe_messages[uri] = self.client.queue("GET", search_uri,
+            self.check_query_valid_cb, uri, timeout = 2,
+            priority = client.PRIORITY_PROBE)
 
     def check_query_valid_cb(self, session, results, uri):
-        if results.status_code != 200:
+        if not self.is_current_probe(uri, results):
             return False
 
+        if results.status_code != 200:
+            return self.probe_failure(uri, f"search status {results.status_code}")
+
         try:
             instance_json = json.loads(results.response_body.data)
         except:
-            return False
+            return self.probe_failure(uri, "search response malformed")
 
         # only need to check if 'type' appears
         for r in instance_json:
             if 'type' in r:
                 self.check_video_api_valid(uri)
-                break
+                return
+
+        return self.probe_failure(uri, "search returned no results")
 
     # check the instances return a valid API
     def check_video_api_valid(self, uri):
@@ -98,37 +323,43 @@ class Instances:
         # /api/v1/videos/{videoId}
         # /api/v1/videos/cAUNrY_qPCg?fields=type
         fs_uri = f"{uri}/api/v1/videos/cAUNrY_qPCg?fields=formatStreams"
-        session = Soup.Session.new()
-        session.set_property("timeout", 2)
-        message = Soup.Message.new("GET", fs_uri)
-        session.queue_message(message, self.check_video_api_valid_cb, uri)
+        self.probe_messages[uri] = self.client.queue("GET", fs_uri,
+            self.check_video_api_valid_cb, uri, timeout = 2,
+            priority = client.PRIORITY_PROBE)
 
     def check_video_api_valid_cb(self, session, results, uri):
-        if results.status_code != 200:
+        if not self.is_current_probe(uri, results):
             return False
 
+        if results.status_code != 200:
+            return self.probe_failure(uri, f"video api status {results.status_code}")
+
         try:
             instance_json = json.loads(results.response_body.data)
         except:
-            return False
+            return self.probe_failure(uri, "video api response malformed")
 
         # verify json has key 'formatStreams' (not 'error')
-        if 'formatStreams' in instance_json:
+        if 'formatStreams' in instance_json and instance_json['formatStreams']:
             fs = instance_json['formatStreams'][0]
             if fs['type'].startswith('video/mp4'):
                 confirm_video = fs['url']
                 self.check_video_valid(uri, confirm_video)
+                return
+
+        return self.probe_failure(uri, "video api has no mp4 format stream")
 
     def check_video_valid(self, uri, confirm_video):
-        session = Soup.Session.new()
-        session.set_property("timeout", 2)
-        message = Soup.Message.new("HEAD", confirm_video)
-        session.queue_message(message, self.check_video_valid_cb, uri)
+        self.probe_messages[uri] = self.client.queue("HEAD", confirm_video,
+            self.check_video_valid_cb, uri, timeout = 2,
+            priority = client.PRIORITY_PROBE)
 
     def check_video_valid_cb(self, session, results, uri):
-        if results.status_code != 200:
+        if not self.is_current_probe(uri, results):
             return False
 
-        self.app_window.strong_instances.append(uri)
-        self.app_window.strong_instance_found()
-        self.app_window.status_icon.set_property('icon-name', 'object-select-symbolic')
+        if results.status_code != 200:
+            return self.probe_failure(uri, f"video status {results.status_code}")
+
+        self.probe_success(uri)
+        self.add_strong_instance(uri)
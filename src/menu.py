@@ -17,7 +17,7 @@
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk
+from gi.repository import Gio, Gtk
 
 from .preferences import Preferences
 from .help import Help
@@ -33,6 +33,7 @@ class Menu(Gtk.PopoverMenu):
     speed = Gtk.Template.Child()
 
     incognito_mode = Gtk.Template.Child()
+    audio_only_mode = Gtk.Template.Child()
     mode_switcher = Gtk.Template.Child()
 
     def __init__(self, app_window, **kwargs):
@@ -40,6 +41,9 @@ class Menu(Gtk.PopoverMenu):
 
         self.app_window = app_window
 
+        self.app_window.settings.bind('audio-only', self.audio_only_mode,
+            'active', Gio.SettingsBindFlags.DEFAULT)
+
     @Gtk.Template.Callback()
     def volume_change(self, event):
         self.volume_setting(event.get_value())
@@ -60,10 +64,9 @@ class Menu(Gtk.PopoverMenu):
     def volume_setting(self, volume_value):
         # gstreamer uses decimal 0.0 to 1.0 for volume
         volume_decimal = volume_value / 100
-        list = self.app_window.get_scroller_list()
-        children = list.get_children()
-        for child in children:
-            child.get_child().player.set_property("volume", volume_decimal)
+        # every result plays through one of the pooled players
+        for player in self.app_window.players.players:
+            player.set_property("volume", volume_decimal)
 
     def speed_setting(self, speed_value):
         list = self.app_window.get_scroller_list()
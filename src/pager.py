@@ -0,0 +1,99 @@
+# pager.py
+#
+# Copyright 2021 Purism, SPC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from . import client
+
+class Pager:
+
+    # pages fetched ahead of the next one to show
+    prefetch_pages = 1
+
+    def __init__(self, **kwargs):
+        self.search = kwargs.get('search', None)
+        self.query = kwargs.get('query', None)
+
+        self.shown_page = 0
+        # page the user is waiting on, shown as soon as it arrives
+        self.wanted_page = None
+        # at most one outstanding request per page
+        self.in_flight = set()
+        # page -> (instance, search_json) fetched ahead, not shown yet
+        self.buffered = {}
+        # set once a page comes back empty, there is nothing after it
+        self.last_page = None
+
+    def is_past_end(self, page):
+        return self.last_page is not None and page > self.last_page
+
+    def show_next(self):
+        page = self.shown_page + 1
+        if self.wanted_page == page or self.is_past_end(page):
+            return False
+
+        if page in self.buffered:
+            instance, search_json = self.buffered.pop(page)
+            self.show_page(page, instance, search_json)
+        else:
+            self.wanted_page = page
+            self.search.toggle_status_spinner(True)
+            if page in self.in_flight:
+                # prefetched, but the user is waiting on it now
+                self.search.set_page_priority(page, client.PRIORITY_VISIBLE)
+            self.fetch(page)
+
+        self.prefetch()
+
+    def prefetch(self):
+        first = self.shown_page + 1
+        for page in range(first, first + self.prefetch_pages + 1):
+            self.fetch(page)
+
+    def fetch(self, page):
+        if (page in self.in_flight or page in self.buffered or
+                page <= self.shown_page or self.is_past_end(page)):
+            return False
+
+        if page == self.wanted_page:
+            priority = client.PRIORITY_VISIBLE
+        else:
+            priority = client.PRIORITY_PREFETCH
+
+        self.in_flight.add(page)
+        self.search.do_search(query = self.query, page = page,
+            page_fetched = self.page_fetched, priority = priority)
+
+    def page_fetched(self, page, instance, search_json):
+        self.in_flight.discard(page)
+
+        if search_json is not None and not search_json:
+            # no results on this page, so none after it either
+            if self.last_page is None or page - 1 < self.last_page:
+                self.last_page = page - 1
+
+        if page == self.wanted_page:
+            self.wanted_page = None
+            if search_json:
+                self.show_page(page, instance, search_json)
+                self.prefetch()
+            else:
+                self.search.toggle_status_spinner(False)
+        elif search_json:
+            self.buffered[page] = (instance, search_json)
+
+    def show_page(self, page, instance, search_json):
+        self.shown_page = page
+        self.search.show_page(instance, search_json)
@@ -0,0 +1,196 @@
+# players.py
+#
+# Copyright 2021 Purism, SPC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, Gst
+
+from .adaptive import AdaptivePlayer
+
+class Player:
+
+    # a pipeline and its video sink (and widget), moved between
+    # result boxes by the PlayerPool. It has the parts of playbin
+    # that ResultsBox uses and passes them to the current pipeline.
+
+    def __init__(self):
+        self.playbin = Gst.ElementFactory.make("playbin")
+        self.sink = Gst.ElementFactory.make("gtksink")
+        self.widget = self.sink.get_property("widget")
+
+        self.adaptive_player = None
+        # playbin or the adaptive player, whichever is loaded
+        self.element = self.playbin
+        self.state = Gst.State.NULL
+
+        # (videoId, mode) loaded into the pipeline
+        self.loaded = None
+        self.video_meta = None
+        # result box the player is attached to
+        self.owner = None
+        # monotonic time of the last acquire, for eviction
+        self.used = 0
+
+    def load(self, video_meta, mode, max_height = None):
+        # mode is 'muxed', 'adaptive' or 'audio'
+        loaded = (video_meta['videoId'], mode)
+        if loaded == self.loaded:
+            return False
+
+        self.unload()
+        self.video_meta = video_meta
+
+        if mode == 'audio':
+            # the audio rendition has no video track, so nothing is
+            # fetched, decoded or drawn for the picture
+            self.playbin.set_property("uri", video_meta['adaptive_audio']['url'])
+        elif mode == 'adaptive':
+            self.adaptive_player = AdaptivePlayer(video_sink = self.sink,
+                video_formats = video_meta['adaptive_video'],
+                audio_format = video_meta['adaptive_audio'],
+                max_height = max_height,
+                error_cb = self.adaptive_failed)
+            self.element = self.adaptive_player
+        else:
+            self.load_playbin(video_meta)
+
+        self.loaded = loaded
+
+    def load_playbin(self, video_meta):
+        self.playbin.set_property("video-sink", self.sink)
+        self.playbin.set_property("uri", video_meta['video_uri'])
+        self.element = self.playbin
+
+    def unload(self):
+        self.set_state(Gst.State.NULL)
+        self.release_adaptive_player()
+        self.element = self.playbin
+        self.loaded = None
+
+    def adaptive_failed(self, adaptive_player):
+        # fall back to the muxed stream, in the same state
+        state = self.state
+        self.release_adaptive_player()
+        self.load_playbin(self.video_meta)
+        self.loaded = (self.video_meta['videoId'], 'muxed')
+        if state in [Gst.State.PAUSED, Gst.State.PLAYING]:
+            self.set_state(state)
+
+    def release_adaptive_player(self):
+        if self.adaptive_player:
+            self.adaptive_player.release()
+            self.adaptive_player = None
+
+    # playbin compatible
+
+    def set_state(self, state):
+        self.state = state
+        return self.element.set_state(state)
+
+    def set_property(self, name, value):
+        self.element.set_property(name, value)
+
+    def query(self, query):
+        return self.element.query(query)
+
+    def query_position(self, format):
+        return self.element.query_position(format)
+
+    def query_duration(self, format):
+        return self.element.query_duration(format)
+
+    def seek_simple(self, format, flags, position):
+        return self.element.seek_simple(format, flags, position)
+
+class PlayerPool:
+
+    # pipelines kept, normally the one playing and one prerolled
+    # for the result played next, every other result shows its poster
+    pool_size = 2
+
+    def __init__(self):
+        self.players = []
+        # player of the result that is playing (or paused)
+        self.active = None
+
+    def acquire(self, owner):
+        # the player attached to owner, attaching one if needed,
+        # owner is told with player_attached and player_detached
+        now = GLib.get_monotonic_time()
+        for player in self.players:
+            if player.owner is owner:
+                player.used = now
+                return player
+
+        player = self.get_spare()
+        self.detach(player)
+        player.owner = owner
+        player.used = now
+        owner.player_attached(player)
+        return player
+
+    def get_spare(self):
+        for player in self.players:
+            if not player.owner:
+                return player
+
+        if len(self.players) < self.pool_size:
+            player = Player()
+            self.players.append(player)
+            return player
+
+        # the least recently used one that is not playing
+        players = [player for player in self.players
+                   if player is not self.active] or self.players
+        return min(players, key = lambda player: player.used)
+
+    def detach(self, player):
+        player.unload()
+        if self.active is player:
+            self.active = None
+
+        owner = player.owner
+        player.owner = None
+        if owner:
+            owner.player_detached(player)
+
+        # the widget is reparented into the next owner
+        parent = player.widget.get_parent()
+        if parent:
+            parent.remove(player.widget)
+
+    def preroll(self, owner, video_meta, mode, max_height = None):
+        # get the pipeline of the next result ready, paused on
+        # its first frame, without disturbing the active one
+        player = self.acquire(owner)
+        if player is self.active:
+            return False
+        player.load(video_meta, mode, max_height)
+        player.set_state(Gst.State.PAUSED)
+
+    def activate(self, player):
+        self.active = player
+
+    def deactivate(self, player):
+        if self.active is player:
+            self.active = None
+
+    def release(self, owner):
+        # owner is going away, the player is free for others
+        for player in self.players:
+            if player.owner is owner:
+                self.detach(player)
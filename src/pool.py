@@ -0,0 +1,189 @@
+# pool.py
+#
+# Copyright 2021 Purism, SPC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gi
+gi.require_version('Soup', '2.4')
+from gi.repository import GLib, Soup
+
+from . import client
+
+class InstancePool:
+
+    # weight of the newest measurement in the rolling averages
+    smoothing = 0.3
+    # typical api response size, used to fold throughput into the score
+    typical_bytes = 16 * 1024
+    # score given to instances without any measurement yet
+    unmeasured_latency = 1.0
+
+    # circuit breaker: consecutive failures before an instance is
+    # taken out of rotation, and seconds before it gets a trial request
+    failure_threshold = 3
+    cooldown = 30
+
+    def __init__(self):
+        # ranked list of strong instance uris, fastest first
+        self.instances = []
+        # uri -> { 'latency': seconds, 'throughput': bytes per second }
+        self.stats = {}
+        # host -> uri, to match requests back to their instance
+        self.hosts = {}
+        # uri -> { 'state': closed|open|half-open, 'failures', 'opened' }
+        self.breakers = {}
+
+        client.get_default().observers.append(self.request_finished)
+
+    def __len__(self):
+        return len(self.instances)
+
+    def __iter__(self):
+        return iter(list(self.instances))
+
+    def __contains__(self, uri):
+        return uri in self.instances
+
+    def __getitem__(self, index):
+        return self.instances[index]
+
+    def watch(self, uri, latency = None):
+        # start timing requests to an instance that is not strong (yet)
+        if uri not in self.stats:
+            self.stats[uri] = { 'latency': latency, 'throughput': None }
+        self.hosts[self.get_host(uri)] = uri
+
+    def add(self, uri, latency = None):
+        self.watch(uri, latency)
+
+        if uri not in self.instances:
+            self.instances.append(uri)
+            self.rank()
+
+    def remove(self, uri):
+        if uri in self.instances:
+            self.instances.remove(uri)
+
+    def best(self):
+        uri = self.next_instance()
+        if not uri and self.instances:
+            # every breaker is open, the fastest is still the best guess
+            uri = self.instances[0]
+        return uri
+
+    def next_instance(self, tried = ()):
+        # fastest instance that is healthy and not already tried
+        for uri in self.instances:
+            if uri not in tried and self.is_available(uri):
+                return uri
+        return None
+
+    def get_breaker(self, uri):
+        return self.breakers.setdefault(uri, { 'state': 'closed',
+                                               'failures': 0,
+                                               'opened': 0 })
+
+    def is_available(self, uri):
+        breaker = self.get_breaker(uri)
+        if breaker['state'] == 'closed':
+            return True
+
+        now = GLib.get_monotonic_time() / GLib.USEC_PER_SEC
+        if now - breaker['opened'] < self.cooldown:
+            # open, or half-open with the trial request still out
+            return False
+
+        # cooled down (or the last trial never reported back),
+        # let a single trial request through
+        breaker['state'] = 'half-open'
+        breaker['opened'] = now
+        return True
+
+    def record_success(self, uri):
+        breaker = self.get_breaker(uri)
+        breaker['state'] = 'closed'
+        breaker['failures'] = 0
+
+    def record_failure(self, uri):
+        breaker = self.get_breaker(uri)
+        breaker['failures'] += 1
+
+        if (breaker['state'] == 'half-open' or
+                breaker['failures'] >= self.failure_threshold):
+            breaker['state'] = 'open'
+            breaker['opened'] = GLib.get_monotonic_time() / GLib.USEC_PER_SEC
+
+    def get_host(self, uri):
+        soup_uri = Soup.URI.new(uri)
+        if soup_uri:
+            return self.get_host_key(soup_uri)
+        return uri
+
+    def get_host_key(self, soup_uri):
+        # instances can share a host on different ports
+        return f"{soup_uri.get_host()}:{soup_uri.get_port()}"
+
+    def get_latency(self, uri):
+        stats = self.stats.get(uri)
+        if not stats or stats['latency'] is None:
+            return None
+        return stats['latency']
+
+    def get_score(self, uri):
+        # estimated seconds to fetch a typical api response
+        stats = self.stats.get(uri)
+        if not stats or stats['latency'] is None:
+            return self.unmeasured_latency
+
+        score = stats['latency']
+        if stats['throughput']:
+            score += self.typical_bytes / stats['throughput']
+        return score
+
+    def rank(self):
+        self.instances.sort(key = self.get_score)
+
+    def smooth(self, old, new):
+        if old is None:
+            return new
+        return old + self.smoothing * (new - old)
+
+    def record(self, uri, latency, nbytes = 0):
+        stats = self.stats.setdefault(uri, { 'latency': None, 'throughput': None })
+        stats['latency'] = self.smooth(stats['latency'], latency)
+        if nbytes and latency > 0:
+            stats['throughput'] = self.smooth(stats['throughput'], nbytes / latency)
+
+        if uri in self.instances:
+            self.rank()
+
+    def request_finished(self, message, elapsed):
+        host = self.get_host_key(message.get_uri())
+        if host not in self.hosts:
+            return
+
+        uri = self.hosts[host]
+        status = message.status_code
+        if status == Soup.Status.OK:
+            self.record(uri, elapsed, message.response_body.length)
+            self.record_success(uri)
+        elif status == Soup.Status.CANCELLED:
+            return
+        elif status < 100 or status >= 500:
+            # transport errors and server errors count against the breaker
+            if status == Soup.Status.IO_ERROR:
+                # timed out, count the full wait against the instance
+                self.record(uri, elapsed)
+            self.record_failure(uri)
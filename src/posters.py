@@ -0,0 +1,326 @@
+# posters.py
+#
+# Copyright 2021 Purism, SPC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gi
+gi.require_version('Soup', '2.4')
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf, Gio, GLib, Soup
+
+from collections import OrderedDict
+import json
+import os
+
+from . import client
+from . import worker
+
+class PosterCache:
+
+    # seconds a poster is used without asking the server again,
+    # unless it sends a longer max-age
+    min_max_age = 24 * 60 * 60
+    # seconds the index waits before it is written
+    write_delay = 2
+    # share a poster rendition may be scaled up to fit its box
+    max_upscale = 0.15
+
+    def __init__(self, **kwargs):
+        # poster bytes are kept on disk named by their sha1, so the
+        # same poster from different instances is stored once
+        self.cache_dir = kwargs.get('cache_dir', None)
+        self.disk_max_bytes = kwargs.get('disk_max_bytes', 64 * 1024 * 1024)
+        # decoded pixbufs kept in memory
+        self.memory_max_bytes = kwargs.get('memory_max_bytes', 32 * 1024 * 1024)
+
+        self.client = client.get_default()
+
+        # key -> { 'hash', 'size', 'etag', 'modified', 'expires', 'used' }
+        self.index = {}
+        self.index_file = None
+        self.disk_bytes = 0
+        self.write_id = 0
+
+        # (key, width, height) -> pixbuf, least recently used first
+        self.pixbufs = OrderedDict()
+        self.memory_bytes = 0
+
+        # key -> { 'message', 'waiters': [(callback, user_data)] }
+        self.fetching = {}
+
+        if self.cache_dir:
+            try:
+                os.makedirs(self.cache_dir, exist_ok = True)
+                self.index_file = os.path.join(self.cache_dir, 'index.json')
+                self.read_index()
+            except:
+                self.cache_dir = None
+
+    def now(self):
+        return GLib.get_real_time() / GLib.USEC_PER_SEC
+
+    def get_key(self, uri):
+        # instances proxy the same thumbnails, so the path is the key
+        soup_uri = Soup.URI.new(uri)
+        if not soup_uri:
+            return uri
+        query = soup_uri.get_query()
+        if query:
+            return f"{soup_uri.get_path()}?{query}"
+        return soup_uri.get_path()
+
+    def get_path(self, content_hash):
+        return os.path.join(self.cache_dir, content_hash)
+
+    def pick_uris(self, poster_uris, width):
+        # poster_uris are [width, uri] renditions, smallest first.
+        # The smallest one that needs at most max_upscale to fill the
+        # box is picked (the 320 px medium for the small box), then the
+        # smaller ones follow in case it is missing (not every video
+        # has a maxres one).
+        min_width = width / (1 + self.max_upscale)
+        picked = [uri for rendition_width, uri in poster_uris
+                  if rendition_width >= min_width][:1]
+        smaller = [uri for rendition_width, uri in poster_uris
+                   if rendition_width < min_width]
+        return picked + smaller[::-1]
+
+    # decoded pixbufs
+
+    def decode(self, poster_bytes, uri, width, height, callback, user_data = None):
+        # decoded and scaled on the worker thread, then kept in the
+        # pixbuf cache. callback(pixbuf, user_data) gets None if the
+        # poster could not be decoded.
+        worker.get_default().submit(decode_poster,
+            (poster_bytes, width, height),
+            self.decode_cb, (uri, width, height, callback, user_data))
+
+    def decode_cb(self, pixbuf, request):
+        uri, width, height, callback, user_data = request
+        if pixbuf:
+            self.put_pixbuf(uri, width, height, pixbuf)
+        callback(pixbuf, user_data)
+
+    def get_pixbuf(self, uri, width, height):
+        cache_key = (self.get_key(uri), width, height)
+        pixbuf = self.pixbufs.get(cache_key)
+        if pixbuf:
+            self.pixbufs.move_to_end(cache_key)
+        return pixbuf
+
+    def put_pixbuf(self, uri, width, height, pixbuf):
+        cache_key = (self.get_key(uri), width, height)
+        old = self.pixbufs.pop(cache_key, None)
+        if old:
+            self.memory_bytes -= old.get_byte_length()
+
+        self.pixbufs[cache_key] = pixbuf
+        self.memory_bytes += pixbuf.get_byte_length()
+        self.evict_pixbufs(self.memory_max_bytes, keep = 1)
+
+    def evict_pixbufs(self, max_bytes, keep = 0):
+        # least recently used first, until max_bytes fits
+        while self.memory_bytes > max_bytes and len(self.pixbufs) > keep:
+            cache_key, evicted = self.pixbufs.popitem(last = False)
+            self.memory_bytes -= evicted.get_byte_length()
+
+    def trim(self, level):
+        # the system runs low on memory, decoded posters are
+        # dropped (they decode again from the bytes on disk)
+        if level >= Gio.MemoryMonitorWarningLevel.CRITICAL:
+            self.evict_pixbufs(0)
+        else:
+            self.evict_pixbufs(self.memory_bytes // 2)
+
+    # poster bytes
+
+    def fetch(self, uri, callback, user_data = None, priority = client.PRIORITY_VISIBLE):
+        # callback(poster_bytes, user_data) gets the poster as
+        # GLib.Bytes, or None if it could not be loaded. Returns the
+        # message when the network is asked (for set_priority).
+        key = self.get_key(uri)
+
+        fetching = self.fetching.get(key)
+        if fetching:
+            fetching['waiters'].append((callback, user_data))
+            return fetching['message']
+
+        entry = self.index.get(key)
+        if entry and entry['expires'] > self.now():
+            poster_bytes = self.read_entry(key, entry)
+            if poster_bytes:
+                GLib.idle_add(self.idle_done_cb, callback, poster_bytes, user_data)
+                return None
+
+        message = self.client.queue("GET", uri, self.fetch_cb, key,
+            timeout = 10, priority = priority)
+
+        entry = self.index.get(key)
+        if entry:
+            # only download the poster again if it changed
+            if entry.get('etag'):
+                message.request_headers.replace('If-None-Match', entry['etag'])
+            if entry.get('modified'):
+                message.request_headers.replace('If-Modified-Since', entry['modified'])
+
+        self.fetching[key] = { 'message': message,
+                               'waiters': [(callback, user_data)] }
+        return message
+
+    def idle_done_cb(self, callback, poster_bytes, user_data):
+        callback(poster_bytes, user_data)
+        return False
+
+    def fetch_cb(self, session, message, key):
+        fetching = self.fetching.pop(key, None)
+        if not fetching:
+            return False
+
+        entry = self.index.get(key)
+        poster_bytes = None
+        if message.status_code == Soup.Status.OK:
+            poster_bytes = message.response_body.flatten().get_as_bytes()
+            self.put_entry(key, message, poster_bytes)
+        elif message.status_code == Soup.Status.NOT_MODIFIED and entry:
+            entry['expires'] = self.get_expires(message)
+            poster_bytes = self.read_entry(key, entry)
+            self.queue_write()
+        elif entry:
+            # the server failed, a stale poster beats none
+            poster_bytes = self.read_entry(key, entry)
+
+        for callback, user_data in fetching['waiters']:
+            callback(poster_bytes, user_data)
+
+    def cancel(self, owner):
+        # detach the callbacks bound to owner, the download is
+        # cancelled once nobody waits for it anymore
+        for key, fetching in list(self.fetching.items()):
+            waiters = fetching['waiters']
+            waiters[:] = [waiter for waiter in waiters
+                          if getattr(waiter[0], '__self__', None) is not owner]
+            if not waiters:
+                del self.fetching[key]
+                self.client.cancel(fetching['message'], self)
+
+    def get_expires(self, message):
+        max_age = 0
+        cache_control = message.response_headers.get_one('Cache-Control')
+        if cache_control:
+            for directive in cache_control.split(','):
+                name, _, value = directive.strip().partition('=')
+                if name == 'max-age':
+                    try:
+                        max_age = int(value)
+                    except ValueError:
+                        pass
+        return self.now() + max(max_age, self.min_max_age)
+
+    def read_entry(self, key, entry):
+        if not self.cache_dir:
+            return None
+
+        try:
+            with open(self.get_path(entry['hash']), 'rb') as file:
+                data = file.read()
+        except:
+            # gone from disk, forget it
+            self.remove_entry(key)
+            return None
+
+        entry['used'] = self.now()
+        self.queue_write()
+        return GLib.Bytes.new(data)
+
+    def put_entry(self, key, message, poster_bytes):
+        if not self.cache_dir:
+            return False
+
+        data = poster_bytes.get_data()
+        content_hash = GLib.compute_checksum_for_bytes(GLib.ChecksumType.SHA1,
+            poster_bytes)
+        path = self.get_path(content_hash)
+        if not os.path.exists(path):
+            try:
+                with open(path, 'wb') as file:
+                    file.write(data)
+            except:
+                return False
+
+        self.remove_entry(key, keep_hash = content_hash)
+        headers = message.response_headers
+        self.index[key] = { 'hash': content_hash,
+                            'size': len(data),
+                            'etag': headers.get_one('ETag'),
+                            'modified': headers.get_one('Last-Modified'),
+                            'expires': self.get_expires(message),
+                            'used': self.now() }
+        self.update_disk_bytes()
+        self.evict()
+        self.queue_write()
+
+    def remove_entry(self, key, keep_hash = None):
+        entry = self.index.pop(key, None)
+        if not entry or entry['hash'] == keep_hash:
+            return False
+
+        # the file may be shared with other keys (same content)
+        if not any(other['hash'] == entry['hash'] for other in self.index.values()):
+            try:
+                os.remove(self.get_path(entry['hash']))
+            except:
+                pass
+        self.update_disk_bytes()
+
+    def update_disk_bytes(self):
+        sizes = {}
+        for entry in self.index.values():
+            sizes[entry['hash']] = entry['size']
+        self.disk_bytes = sum(sizes.values())
+
+    def evict(self):
+        # least recently used first, until the budget fits
+        while self.disk_bytes > self.disk_max_bytes and self.index:
+            key = min(self.index, key = lambda key: self.index[key]['used'])
+            self.remove_entry(key)
+
+    def read_index(self):
+        try:
+            with open(self.index_file) as file:
+                self.index = json.load(file)
+        except:
+            self.index = {}
+        self.update_disk_bytes()
+        self.evict()
+
+    def write_index(self):
+        self.write_id = 0
+        try:
+            with open(self.index_file, 'w') as file:
+                json.dump(self.index, file)
+        except:
+            pass
+        return False
+
+    def queue_write(self):
+        if self.index_file and not self.write_id:
+            self.write_id = GLib.timeout_add_seconds(self.write_delay, self.write_index)
+
+# runs on the worker thread
+def decode_poster(poster_bytes, width, height):
+    stream = Gio.MemoryInputStream.new_from_bytes(poster_bytes)
+    return GdkPixbuf.Pixbuf.new_from_stream_at_scale(stream, width, height,
+        True,   # preserve_aspect_ratio
+        None)   # cancellable
@@ -0,0 +1,189 @@
+# quality.py
+#
+# Copyright 2021 Purism, SPC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from . import client
+
+class BandwidthEstimator:
+
+    # weight of the newest measurement in the rolling average
+    smoothing = 0.3
+    # smaller transfers are mostly latency and say little about bandwidth
+    min_bytes = 8 * 1024
+    # only media transfers (posters, streams) are measured, api
+    # responses are slowed down by the instance doing the search
+    media_types = [ 'image/', 'video/', 'audio/' ]
+
+    def __init__(self):
+        # bits per second, None until something was measured
+        self.bandwidth = None
+
+        client.get_default().observers.append(self.request_finished)
+
+    def request_finished(self, message, elapsed):
+        if message.status_code != 200:
+            return
+
+        content_type, params = message.response_headers.get_content_type()
+        if not content_type:
+            return
+        if not any(content_type.startswith(t) for t in self.media_types):
+            return
+
+        self.record(message.response_body.length, elapsed)
+
+    def record(self, nbytes, seconds):
+        if nbytes < self.min_bytes or seconds <= 0:
+            return
+        self.record_rate(nbytes * 8 / seconds)
+
+    def record_rate(self, bits_per_second):
+        # e.g. the download rate a playing stream reports
+        if bits_per_second <= 0:
+            return
+        if self.bandwidth is None:
+            self.bandwidth = bits_per_second
+        else:
+            self.bandwidth += self.smoothing * (bits_per_second - self.bandwidth)
+
+    def get_estimate(self):
+        return self.bandwidth
+
+class FormatSelector:
+
+    # bits per second assumed for muxed streams, which
+    # (unlike adaptive formats) do not list their bitrate
+    nominal_bitrates = { 144: 150000,
+                         240: 300000,
+                         360: 700000,
+                         480: 1200000,
+                         720: 2500000,
+                         1080: 4500000,
+                         1440: 9000000,
+                         2160: 18000000 }
+    # share of the estimated bandwidth a stream may use
+    headroom = 0.75
+    # picked while nothing was measured yet
+    fallback_height = 360
+
+    def __init__(self, **kwargs):
+        # bits per second, None if unknown
+        self.bandwidth = kwargs.get('bandwidth', None)
+        # highest video height to pick, None for no cap
+        self.max_height = kwargs.get('max_height', None)
+
+    def get_height(self, fmt):
+        # "720p", "720p60", "1080p HDR"
+        label = fmt.get('qualityLabel') or fmt.get('resolution') or ''
+        digits = ''
+        for c in label:
+            if not c.isdigit():
+                break
+            digits += c
+        if digits:
+            return int(digits)
+        return None
+
+    def get_bitrate(self, fmt):
+        try:
+            return int(fmt['bitrate'])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        height = self.get_height(fmt)
+        if height is None:
+            return None
+        for nominal_height in sorted(self.nominal_bitrates):
+            if height <= nominal_height:
+                return self.nominal_bitrates[nominal_height]
+        return self.nominal_bitrates[max(self.nominal_bitrates)]
+
+    def is_capped(self, fmt):
+        height = self.get_height(fmt)
+        return self.max_height and height and height > self.max_height
+
+    def fits(self, fmt, extra_bitrate = 0):
+        if self.bandwidth is None:
+            height = self.get_height(fmt)
+            return height is not None and height <= self.fallback_height
+
+        bitrate = self.get_bitrate(fmt)
+        if bitrate is None:
+            return False
+        return bitrate + extra_bitrate <= self.bandwidth * self.headroom
+
+    def get_video_formats(self, formats, container = 'mp4', codec = None):
+        return [fmt for fmt in formats
+                if fmt.get('type', '').startswith(f"video/{container}") and
+                (not codec or codec in fmt['type']) and
+                fmt.get('url') and self.get_height(fmt)]
+
+    def get_audio_formats(self, formats, container = 'mp4'):
+        return [fmt for fmt in formats
+                if fmt.get('type', '').startswith(f"audio/{container}") and
+                fmt.get('url')]
+
+    def pick_video(self, formats, extra_bitrate = 0):
+        # highest quality video within the cap that fits the bandwidth,
+        # or the lowest one if none does (a stall beats no playback)
+        candidates = [fmt for fmt in self.get_video_formats(formats)
+                      if not self.is_capped(fmt)]
+        if not candidates:
+            candidates = self.get_video_formats(formats)
+        if not candidates:
+            return None
+
+        candidates.sort(key = lambda fmt: (self.get_height(fmt),
+                                           self.get_bitrate(fmt) or 0))
+        for fmt in reversed(candidates):
+            if self.fits(fmt, extra_bitrate):
+                return fmt
+        return candidates[0]
+
+    def pick_best_video(self, formats):
+        # highest quality within the cap, regardless of bandwidth
+        # (a download only takes longer on a slow link)
+        candidates = [fmt for fmt in self.get_video_formats(formats)
+                      if not self.is_capped(fmt)]
+        if not candidates:
+            candidates = self.get_video_formats(formats)
+        if not candidates:
+            return None
+
+        return max(candidates, key = lambda fmt: (self.get_height(fmt),
+                                                  self.get_bitrate(fmt) or 0))
+
+    def pick_best_audio(self, formats):
+        candidates = self.get_audio_formats(formats)
+        if not candidates:
+            return None
+        return max(candidates, key = lambda fmt: self.get_bitrate(fmt) or 0)
+
+def get_max_height(settings):
+    # the max-video-quality setting, None when not capped
+    max_quality = settings.get_string('max-video-quality')
+    if max_quality == 'auto':
+        return None
+    return int(max_quality.rstrip('p'))
+
+# one estimate for the whole app, all transfers share the link
+default_estimator = None
+
+def get_default():
+    global default_estimator
+    if not default_estimator:
+        default_estimator = BandwidthEstimator()
+    return default_estimator
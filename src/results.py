@@ -20,12 +20,14 @@ gi.require_version('Gtk', '3.0')
 gi.require_version('Gdk', '3.0')
 gi.require_version('Gio', '2.0')
 gi.require_version('Gst', '1.0')
-from gi.repository import Gdk, GdkPixbuf, Gio, GLib, Gst, Gtk
+from gi.repository import Gdk, Gio, GLib, Gst, Gtk
 
 Gst.init(None)
 Gst.init_check(None)
 
 from .search import Search
+from . import client
+from . import quality
 
 @Gtk.Template(resource_path='/sm/puri/Stream/ui/results.ui')
 class ResultsBox(Gtk.Box):
@@ -67,16 +69,50 @@ class ResultsBox(Gtk.Box):
         # listen for motion on the player box for controls show/hide
         self.event_box.add_events(Gdk.EventMask.POINTER_MOTION_MASK)
 
-        # init gstreamer player
-        self.player = Gst.ElementFactory.make("playbin", "player")
-        self.sink = Gst.ElementFactory.make("gtksink")
-
-        self.video_widget = self.sink.get_property("widget")
-
-        self.player_box.add(self.video_widget)
+        # the gstreamer player (and its video widget) is attached
+        # from the app's player pool when this result is played
+        # or prerolled, until then the poster stands in for it
+        self.player = None
+        self.video_widget = None
+        # 'muxed', 'adaptive' or 'audio', see setup_player
+        self.player_mode = None
+        self.preroll_when_resolved = False
+        self.poster_uri = None
+        # [width, uri] poster renditions, and the decoded pixbuf
+        # per box width, so a resize back is only a swap
+        self.poster_uris = []
+        self.poster_pixbufs = {}
+        # (poster_uris, width, height) being loaded, its compressed
+        # bytes once fetched, and whether they are fetching or decoding
+        self.poster_request = None
+        self.poster_bytes = None
+        self.poster_fetching = False
+        self.poster_decoding = None
+        # near the viewport, see set_poster_visible
+        self.poster_visible = False
+        # downloads in progress, the box is not reused meanwhile
+        self.downloads = 0
 
         self.set_player_box_size()
 
+        # poster and stream lookups go through the shared client,
+        # ranked by where this result is relative to the viewport
+        self.client = client.get_default()
+        self.priority = client.PRIORITY_NEAR
+        self.poster_message = None
+        # poster and stream transfers feed the bandwidth estimate
+        # that picks the quality of the next stream
+        self.bandwidth = quality.get_default()
+
+        # streams of lazily added videos are resolved on demand
+        self.stream_resolved = False
+        self.stream_resolving = False
+        self.stream_unplayable = False
+        self.play_when_resolved = False
+        self.resolve_search = None
+        self.connect("focus-in-event", self.focus_in)
+        self.connect("destroy", self.on_destroy)
+
     def set_player_box_size(self):
         # setup player box sizing based on app window (re)size
         size = self.app_window.get_size()
@@ -90,7 +126,8 @@ class ResultsBox(Gtk.Box):
 
         self.player_box.set_size_request(self.video_box_width, self.video_box_height)
         self.poster_image.set_size_request(self.video_box_width, self.video_box_height)
-        self.video_widget.set_size_request(self.video_box_width, self.video_box_height)
+        if self.video_widget:
+            self.video_widget.set_size_request(self.video_box_width, self.video_box_height)
 
         # this is a HdyClamp to tighten the box around the dynamic
         # player box size (determined by window size at time of search)
@@ -110,26 +147,128 @@ class ResultsBox(Gtk.Box):
             readable_seconds = f"{m:d}:{s:02d}"
         return readable_seconds
 
-    def on_file_read(self, poster_file, async_res, user_data):
-        try:
-            stream = poster_file.read_finish(async_res)
-        except GLib.Error as e:
+    def load_poster(self):
+        # the rendition for the current box size, if it was decoded
+        # before (e.g. the window was resized back) it is only swapped in
+        width = self.video_box_width
+        height = self.video_box_height
+        pixbuf = self.poster_pixbufs.get(width)
+        if pixbuf:
+            self.poster_image.set_from_pixbuf(pixbuf)
+            return
+
+        self.poster_image.clear()
+        if self.poster_request and self.poster_request[1] == width:
+            # fetched (or on its way) for this size already
+            return self.decode_poster()
+
+        poster_uris = self.app_window.poster_cache.pick_uris(self.poster_uris, width)
+        if poster_uris:
+            self.load_poster_uri(poster_uris, width, height)
+
+    def load_poster_uri(self, poster_uris, width, height):
+        # poster_uris[0] is loaded, the rest are fallbacks
+        self.poster_uri = poster_uris[0]
+        self.poster_request = (poster_uris, width, height)
+        self.poster_bytes = None
+        self.poster_fetching = False
+
+        # decoded already at this size (e.g. history opened again),
+        # the bytes are only fetched if it is evicted meanwhile
+        if self.app_window.poster_cache.get_pixbuf(self.poster_uri, width, height):
+            return self.decode_poster()
+        self.fetch_poster()
+
+    def fetch_poster(self):
+        self.poster_fetching = True
+        self.poster_message = self.app_window.poster_cache.fetch(self.poster_uri,
+            self.on_poster_fetched, self.poster_request,
+            priority = self.priority)
+
+    def on_poster_fetched(self, poster_bytes, request):
+        self.poster_message = None
+        # the box may have been reused for another result meanwhile
+        if request != self.poster_request:
             return False
+        self.poster_fetching = False
 
-        GdkPixbuf.Pixbuf.new_from_stream_at_scale_async(stream,
-                self.video_box_width, self.video_box_height,
-                True,                # preserve_aspect_ratio
-                None,                # cancellable
-                self.on_stream_load, # callback
-                None)                # user_data
+        if not poster_bytes:
+            return self.load_poster_fallback(request)
 
-    def on_stream_load(self, source, async_res, context):
-        self.pixbuf = GdkPixbuf.Pixbuf.new_from_stream_finish(async_res)
-        self.poster_image.set_from_pixbuf(self.pixbuf)
+        # only the compressed bytes are kept until the row is in view
+        self.poster_bytes = poster_bytes
+        self.decode_poster()
 
-    def stream_at_scale_async(self, poster_file):
-        stream = poster_file.read_async(0, None,
-                self.on_file_read, None)
+    def decode_poster(self):
+        if (not self.poster_visible or not self.poster_request or
+                self.poster_decoding == self.poster_request):
+            return False
+
+        poster_uris, width, height = self.poster_request
+        poster_cache = self.app_window.poster_cache
+
+        # decoded already at this size (e.g. history opened again)
+        pixbuf = poster_cache.get_pixbuf(poster_uris[0], width, height)
+        if pixbuf:
+            return self.on_poster_decoded(pixbuf, self.poster_request)
+
+        if not self.poster_bytes:
+            # evicted from memory before its bytes were fetched
+            if not self.poster_fetching:
+                self.fetch_poster()
+            return False
+
+        self.poster_decoding = self.poster_request
+        poster_cache.decode(self.poster_bytes, poster_uris[0],
+            width, height, self.on_poster_decoded, self.poster_request)
+
+    def on_poster_decoded(self, pixbuf, request):
+        if self.poster_decoding == request:
+            self.poster_decoding = None
+        if request != self.poster_request:
+            return False
+
+        if not pixbuf:
+            return self.load_poster_fallback(request)
+
+        # scrolled away while it was decoding
+        if not self.poster_visible:
+            return False
+
+        poster_uris, width, height = request
+        self.poster_pixbufs[width] = pixbuf
+        if width == self.video_box_width:
+            self.poster_image.set_from_pixbuf(pixbuf)
+
+    def load_poster_fallback(self, request):
+        poster_uris, width, height = request
+        if len(poster_uris) > 1:
+            self.load_poster_uri(poster_uris[1:], width, height)
+
+    def set_poster_visible(self, visible):
+        # called as the results scroll, posters are decoded near
+        # the viewport and dropped (down to their bytes) beyond it
+        if visible == self.poster_visible:
+            return False
+
+        self.poster_visible = visible
+        if visible:
+            self.load_poster()
+        else:
+            self.release_poster_pixbufs()
+
+    def release_poster_pixbufs(self):
+        self.poster_pixbufs = {}
+        self.poster_image.clear()
+
+    def trim_poster(self):
+        # low memory, only a poster on screen at the current size stays
+        if not self.poster_visible:
+            return self.release_poster_pixbufs()
+
+        width = self.video_box_width
+        self.poster_pixbufs = { key: pixbuf for key, pixbuf
+                                in self.poster_pixbufs.items() if key == width }
 
     def setup_stream(self, meta):
         if 'type' in meta:
@@ -148,7 +287,8 @@ class ResultsBox(Gtk.Box):
             self.playlist_id = meta['playlistId']
         self.meta_title = meta['title']
         meta_channel = meta['author']
-        poster_uri = meta['poster_uri']
+        # [width, uri] renditions, older history only has the medium one
+        self.poster_uris = meta.get('poster_uris') or [[0, meta['poster_uri']]]
         # initialize video duration
         self.video_duration = 0
 
@@ -157,11 +297,9 @@ class ResultsBox(Gtk.Box):
         self.channel.set_label(meta_channel)
         self.channel.set_tooltip_text(meta_channel)
 
-        poster_file = Gio.File.new_for_uri(poster_uri)
-        self.stream_at_scale_async(poster_file)
+        self.load_poster()
 
     def setup_playlist(self, playlist_meta):
-        self.app_window.playlist_id = playlist_meta['playlistId']
         self.playlist_overlay.set_visible(True)
         self.controls_box.set_visible(False)
 
@@ -175,8 +313,15 @@ class ResultsBox(Gtk.Box):
         self.duration.set_label(self.video_duration)
         self.time_remaining.set_label(f"-{self.video_duration}")
 
-        self.player.set_property("uri", video_meta['video_uri'])
-        self.player.set_property("video-sink", self.sink)
+        self.video_meta = video_meta
+
+        # lazily added videos have no stream until resolve_stream
+        if video_meta.get('video_uri'):
+            self.setup_streams(video_meta)
+
+    def setup_streams(self, video_meta):
+        # a pooled player is only attached on play or preroll
+        self.stream_resolved = True
 
         if 'audio_dl_uri' in video_meta:
             if video_meta['audio_dl_uri']:
@@ -192,8 +337,160 @@ class ResultsBox(Gtk.Box):
                 # set the download uri for download button
                 self.video_dl_uri = video_meta['video_dl_uri']
 
+    def get_player_mode(self):
+        settings = self.app_window.settings
+        video_meta = self.video_meta
+        if settings.get_boolean('audio-only') and video_meta.get('adaptive_audio'):
+            return 'audio'
+        if (settings.get_boolean('adaptive-playback') and
+                video_meta.get('adaptive_video') and video_meta.get('adaptive_audio')):
+            return 'adaptive'
+        return 'muxed'
+
+    def setup_player(self):
+        # attach a pooled player and load this video into it, in
+        # the mode the settings ask for (reloaded when they changed)
+        self.player_mode = self.get_player_mode()
+        self.app_window.players.acquire(self)
+        self.player.load(self.video_meta, self.player_mode,
+            quality.get_max_height(self.app_window.settings))
+
+    def player_attached(self, player):
+        self.player = player
+        self.video_widget = player.widget
+        self.player_box.add(self.video_widget)
+        self.video_widget.set_size_request(self.video_box_width, self.video_box_height)
+        self.video_widget.hide()
+
+    def player_detached(self, player):
+        # the player moved on to another result
+        self.player = None
+        self.video_widget = None
+        self.reset_player_view()
+
+    def preroll(self):
+        # get ready to play without delay, e.g. the next autoplay video
+        if getattr(self, 'type', None) != 'video' or self.stream_unplayable:
+            return False
+
+        if not self.stream_resolved:
+            self.preroll_when_resolved = True
+            self.resolve_stream()
+            return False
+
+        self.app_window.players.preroll(self, self.video_meta,
+            self.get_player_mode(),
+            quality.get_max_height(self.app_window.settings))
+
+    def resolve_stream(self):
+        if self.type != 'video' or self.stream_resolved or self.stream_resolving:
+            return False
+
+        # only retry a failed video when the user asks to play it
+        if self.stream_unplayable and not self.play_when_resolved:
+            return False
+
+        self.stream_resolving = True
+        self.resolve_search = Search(app_window = self.app_window,
+            toggle_status_spinner = self.app_window.toggle_status_spinner,
+            add_result_meta = self.resolve_stream_cb,
+            video_unplayable = self.resolve_stream_failed,
+            priority = self.priority)
+        self.resolve_search.resolve_video(self.video_meta)
+
+    def resolve_stream_cb(self, video_meta):
+        self.stream_resolving = False
+        self.setup_streams(video_meta)
+
+        if self.play_when_resolved:
+            self.play_when_resolved = False
+            self.play_button(None)
+        elif self.preroll_when_resolved:
+            self.preroll_when_resolved = False
+            self.preroll()
+
+    def resolve_stream_failed(self, video_meta):
+        self.stream_resolving = False
+        self.stream_unplayable = True
+        if self.play_when_resolved:
+            self.play_when_resolved = False
+            self.app_window.toggle_status_spinner(False)
+            self.app_window.osd_display_show("dialog-error-symbolic", "Unplayable")
+
+    def set_priority(self, priority):
+        # called as the results scroll, requests still waiting
+        # for a slot move to the new priority class
+        self.priority = priority
+        if self.poster_message:
+            self.client.set_priority(self.poster_message, priority)
+        if self.resolve_search:
+            self.resolve_search.set_priority(priority)
+
+    def on_destroy(self, widget):
+        self.release()
+
+    def release(self):
+        # hand the player back before its widget goes down with us
+        self.app_window.players.release(self)
+        if self.poster_message:
+            self.app_window.poster_cache.cancel(self)
+            self.poster_message = None
+        if self.resolve_search:
+            self.resolve_search.cancel()
+            self.resolve_search = None
+
+    def is_busy(self):
+        # playing (or paused) and downloading results are not reused
+        players = self.app_window.players
+        return ((self.player and players.active is self.player) or
+                self.downloads > 0)
+
+    def reset(self):
+        # back to a blank box, ready to show another result
+        self.release()
+        self.type = None
+        self.video_meta = None
+        self.stream_resolved = False
+        self.stream_resolving = False
+        self.stream_unplayable = False
+        self.play_when_resolved = False
+        self.preroll_when_resolved = False
+        self.priority = client.PRIORITY_NEAR
+
+        self.poster_uri = None
+        self.poster_uris = []
+        self.poster_pixbufs = {}
+        self.poster_request = None
+        self.poster_bytes = None
+        self.poster_fetching = False
+        self.poster_decoding = None
+        self.poster_visible = False
+        self.poster_image.clear()
+
+        self.playlist_overlay.set_visible(False)
+        self.controls_box.set_visible(True)
+        self.duration.set_visible(True)
+        self.duration.get_parent().set_visible_child(self.duration)
+
+        self.audio_dl.set_sensitive(False)
+        self.video_dl.set_sensitive(False)
+        self.audio_dl_image.set_property('icon-name', 'emblem-music-symbolic')
+        self.video_dl_image.set_property('icon-name', 'emblem-videos-symbolic')
+
+        self.video_duration = 0
+        self.reset_player_view()
+        self.slider.set_sensitive(False)
+
+    def focus_in(self, widget, event):
+        # history only goes to the network when a video is played
+        flowbox = self.get_parent()
+        if flowbox and flowbox.get_parent() == self.app_window.videos_history_list:
+            return False
+        self.resolve_stream()
+        return False
+
     def update_slider(self):
-        if not self.app_window.is_playing:
+        if not self.app_window.is_playing or not self.player:
             return False
         else:
             success, duration = self.player.query_duration(Gst.Format.TIME)
@@ -206,6 +503,8 @@ class ResultsBox(Gtk.Box):
 
             position_value = float(position) / Gst.SECOND * self.percent
 
+            self.record_stream_rate()
+
             if duration > 0 and position > 0:
                 viewed_seconds = int(position / Gst.SECOND)
                 remaining_seconds = int((duration - position) / Gst.SECOND)
@@ -229,6 +528,19 @@ class ResultsBox(Gtk.Box):
 
         return True
 
+    def record_stream_rate(self):
+        # only while the buffer fills, a full buffer is topped
+        # up at the stream bitrate rather than the link speed
+        query = Gst.Query.new_buffering(Gst.Format.TIME)
+        if not self.player.query(query):
+            return False
+
+        busy, percent = query.parse_buffering_percent()
+        mode, avg_in, avg_out, buffering_left = query.parse_buffering_stats()
+        if percent < 100 and avg_in > 0:
+            # bytes per second
+            self.bandwidth.record_rate(avg_in * 8)
+
     def strictify_name(self, s):
         return "".join( x for x in s if (x.isalnum() or x in "_- "))
 
@@ -244,6 +556,7 @@ class ResultsBox(Gtk.Box):
         dest_title = self.strictify_name(self.meta_title)
         dest_path = f"{dest_dir}/{dest_title}.{dest_ext}"
         dest = Gio.File.new_for_path(dest_path)
+        self.downloads += 1
         dl_stream.copy_async(dest, Gio.FileCopyFlags.OVERWRITE,
                 GLib.PRIORITY_LOW, None,
                 self.progress_audio_cb, (),
@@ -262,6 +575,7 @@ class ResultsBox(Gtk.Box):
         dest_path = f"{dest_dir}/{dest_title}.{dest_ext}"
         dest = Gio.File.new_for_path(dest_path)
         flags = Gio.FileCopyFlags
+        self.downloads += 1
         dl_stream.copy_async(dest,
                 # bitwise or (not tuple) for multiple flags
                 Gio.FileCopyFlags.OVERWRITE |
@@ -298,6 +612,7 @@ class ResultsBox(Gtk.Box):
         percentage = round(current_num_bytes / total_num_bytes * 100)
 
     def ready_audio_cb(self, src, async_res, user_data):
+        self.downloads -= 1
         try:
             src.copy_finish(async_res)
         except GLib.Error as e:
@@ -306,6 +621,7 @@ class ResultsBox(Gtk.Box):
         self.show_success_icon('audio')
 
     def ready_video_cb(self, src, async_res, user_data):
+        self.downloads -= 1
         try:
             src.copy_finish(async_res)
         except GLib.Error as e:
@@ -336,21 +652,39 @@ class ResultsBox(Gtk.Box):
 
     @Gtk.Template.Callback()
     def play_button(self, button):
+        if self.type == 'video' and not self.stream_resolved:
+            # play as soon as the stream is resolved
+            self.play_when_resolved = True
+            self.app_window.toggle_status_spinner(True)
+            self.set_priority(client.PRIORITY_VISIBLE)
+            self.resolve_stream()
+            return False
+
         self.box_grab_focus()
         # loop through all child results pausing them
         self.app_window.pause_all(self)
 
+        # audio only may have been switched since the last play
+        self.setup_player()
+        self.app_window.players.activate(self.player)
+        audio_only = self.player_mode == 'audio'
+
         self.play_pause_stack.set_visible_child_name("pause")
         self.app_window.is_playing = True
-        self.app_window.inhibit_app()
+        self.app_window.inhibit_app(audio_only)
         self.player.set_state(Gst.State.PLAYING)
 
         # write the video history
-        self.app_window.write_videos_history(self.video_id)
+        self.app_window.write_videos_history(self.video_id, self.video_meta)
 
-        # hide the poster, show the video
-        self.player_box.show_all()
-        self.poster_image.hide()
+        if audio_only:
+            # the poster stands in for the picture
+            self.video_widget.hide()
+            self.poster_image.show()
+        else:
+            # hide the poster, show the video
+            self.player_box.show_all()
+            self.poster_image.hide()
 
         # initialize the slider
         self.update_slider()
@@ -368,20 +702,34 @@ class ResultsBox(Gtk.Box):
         # update slider to track video time in slider
         GLib.timeout_add_seconds(1, self.update_slider)
 
+        # the pool's spare pipeline gets the next video ready
+        self.app_window.preroll_next(self)
+
     def null_out_player(self):
+        if not self.player:
+            # nothing attached, nothing playing
+            return False
+
         self.inactivate_player()
+        self.app_window.players.deactivate(self.player)
         self.player.set_state(Gst.State.NULL)
+        self.reset_player_view()
+
+    def reset_player_view(self):
+        self.play_pause_stack.set_visible_child_name("play")
         self.slider.set_value(0)
         self.time_viewed.set_label('0:00')
         self.time_remaining.set_label(f"-{self.video_duration}")
-        self.video_widget.hide()
+        if self.video_widget:
+            self.video_widget.hide()
         self.poster_image.show()
 
     @Gtk.Template.Callback()
     def pause_button(self, button):
         self.box_grab_focus()
         self.inactivate_player()
-        self.player.set_state(Gst.State.PAUSED)
+        if self.player:
+            self.player.set_state(Gst.State.PAUSED)
 
     def inactivate_player(self):
         self.play_pause_stack.set_visible_child_name("play")
@@ -389,22 +737,17 @@ class ResultsBox(Gtk.Box):
         self.app_window.uninhibit_app()
 
     def resize_results(self):
-        self.poster_image.clear()
-
         # resize the player boxes to the new window size
         self.set_player_box_size()
 
-        # check if there is an original pixbuf to resize
-        if hasattr(self, "pixbuf"):
-            resize_pixbuf = GdkPixbuf.Pixbuf.scale_simple(self.pixbuf,
-                                self.video_box_width, self.video_box_height,
-                                GdkPixbuf.InterpType.BILINEAR)
-
-            self.poster_image.set_from_pixbuf(resize_pixbuf)
+        # swap in (or load) the poster rendition for the new size
+        if self.poster_uris:
+            self.load_poster()
 
     def resize_player(self, width, height):
         self.poster_image.set_size_request(width, height)
-        self.video_widget.set_size_request(width, height)
+        if self.video_widget:
+            self.video_widget.set_size_request(width, height)
 
     @Gtk.Template.Callback()
     def fullscreen_button(self, button):
@@ -460,6 +803,8 @@ class ResultsBox(Gtk.Box):
 
     @Gtk.Template.Callback()
     def seek_slider(self, scale):
+        if not self.player:
+            return False
         seek = scale.get_value()
 
         # allow seeking when playing
@@ -469,7 +814,7 @@ class ResultsBox(Gtk.Box):
 
     def reverse_keypress(self):
         self.box_grab_focus()
-        if self.app_window.is_playing:
+        if self.app_window.is_playing and self.player:
             success, position = self.player.query_position(Gst.Format.TIME)
             seek = 0
             # extra fast keypresses yield a -1 for position
@@ -482,7 +827,7 @@ class ResultsBox(Gtk.Box):
 
     def forward_keypress(self):
         self.box_grab_focus()
-        if self.app_window.is_playing:
+        if self.app_window.is_playing and self.player:
             p_success, position = self.player.query_position(Gst.Format.TIME)
             d_success, duration = self.player.query_duration(Gst.Format.TIME)
             seek = duration
@@ -496,7 +841,7 @@ class ResultsBox(Gtk.Box):
 
     def videos_history_row_delete(self, event):
         self.app_window.videos_history_json_remove(self.video_id)
-        self.destroy()
+        self.app_window.videos_history_view.remove_result(self)
 
     def poll_mouse(self):
         now_is = int(GLib.get_current_time())
@@ -521,6 +866,7 @@ class ResultsBox(Gtk.Box):
             self.app_window.playlist_search = Search(app_window = self.app_window,
                 toggle_status_spinner = self.app_window.toggle_status_spinner,
                 add_result_meta = self.app_window.add_playlist_result_meta)
+            self.app_window.playlist_id = self.playlist_id
             self.app_window.playlist_search.do_playlist(playlist_id = self.app_window.playlist_id, page = self.app_window.page_playlist)
 
         else:
@@ -16,104 +16,364 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import gi
-gi.require_version('Soup', '2.4')
-from gi.repository import GLib, Soup
+from gi.repository import GLib
 
 import json
 
+from . import client
+from . import quality
+from . import worker
+
 class Search:
 
+    # instances a single request is tried on before giving up
+    max_attempts = 3
+
+    search_fields = "type,title,videoId,playlistId,author,lengthSeconds,videoThumbnails,videoCount,videos"
+
     def __init__(self, **kwargs):
         # for internal plugins only
         self.app_window = kwargs.get('app_window', None)
         self.toggle_status_spinner = kwargs.get('toggle_status_spinner', None)
 
-        self.si_index = 0
-        self.this_instance = self.app_window.strong_instances[self.si_index]
+        self.strong_instances = self.app_window.strong_instances
+        self.this_instance = self.strong_instances.best()
 
         self.search_video_ids = []
         self.search_playlist_ids = []
 
+        self.client = client.get_default()
+        # responses are decoded and shaped off the main loop
+        self.worker = worker.get_default()
+
+        # every request this search started, see cancel
+        self.messages = []
+        self.cancelled = False
+        # page -> race of the page fetch in flight, see fetch_search
+        self.races = {}
+
         # limited access
         self.add_result_meta = kwargs.get('add_result_meta', None)
-
-    def do_search(self, query, page):
-        self.toggle_status_spinner(True)
+        # called when a video could not be resolved on any instance
+        self.video_unplayable = kwargs.get('video_unplayable', None)
+        # client priority class of the requests this search sends
+        self.priority = kwargs.get('priority', client.PRIORITY_VISIBLE)
+
+    def queue(self, method, uri, callback, user_data = None, timeout = None,
+              priority = None):
+        self.messages = [message for message in self.messages
+                         if self.client.is_pending(message)]
+        if priority is None:
+            priority = self.priority
+        message = self.client.queue(method, uri, callback, user_data, timeout,
+                                    priority)
+        self.messages.append(message)
+        return message
+
+    def set_priority(self, priority):
+        # re-rank every request of this search still waiting for a slot
+        self.priority = priority
+        for message in self.messages:
+            self.client.set_priority(message, priority)
+
+    def submit(self, func, args, done_cb, user_data = None):
+        self.worker.submit(func, args, self.submit_done, (done_cb, user_data))
+
+    def submit_done(self, result, job):
+        done_cb, user_data = job
+        if self.cancelled:
+            return False
+        return done_cb(result, user_data)
+
+    def cancel(self):
+        # abort the whole request tree of this search (pages, details,
+        # playable checks), late worker results are dropped
+        self.cancelled = True
+        messages = self.messages
+        self.messages = []
+        for message in messages:
+            self.client.cancel(message, self)
+
+    def use_best_instance(self):
+        # the pool is re-ranked as measurements arrive,
+        # so start every new query on the currently fastest instance
+        if self.strong_instances:
+            self.this_instance = self.strong_instances.best()
+
+    def do_search(self, query, page, page_fetched = None, priority = None):
+        # with page_fetched the page is handed to it as
+        # page_fetched(page, instance, search_json) instead of shown,
+        # search_json is None if the page could not be fetched
+        if not page_fetched:
+            self.toggle_status_spinner(True)
+        self.use_best_instance()
         self.query = query
+
+        # repeated searches (history, paging back) are served from cache
+        cache_key = self.get_cache_key(page)
+        cached = self.app_window.search_cache.get(cache_key)
+        if cached:
+            self.submit(self.decode_search_page,
+                (cached['body'], cached['instance']),
+                self.cached_page_decoded,
+                (page, cached['instance'], page_fetched, priority))
+            return
+
+        self.fetch_search(page, page_fetched, priority)
+
+    def cached_page_decoded(self, search_json, request):
+        page, instance, page_fetched, priority = request
+        if search_json is None:
+            # unreadable cache entry, fetch the page instead
+            self.fetch_search(page, page_fetched, priority)
+            return False
+
+        return self.search_done(page, instance, search_json, page_fetched)
+
+    def fetch_search(self, page, page_fetched, priority = None):
+        # every request sent for this page, the first valid response wins
+        race = { 'page': page,
+                 'page_fetched': page_fetched,
+                 'priority': priority,
+                 'messages': {},
+                 'decoding': 0,
+                 'tried': [],
+                 'won': False,
+                 'hedge_id': 0 }
+        self.races[page] = race
+        self.queue_search(race, self.this_instance)
+
+        settings = self.app_window.settings
+        if settings.get_boolean('search-hedging'):
+            delay = settings.get_uint('search-hedge-delay')
+            if delay:
+                race['hedge_id'] = GLib.timeout_add(delay, self.hedge_search, race)
+            else:
+                self.hedge_search(race)
+
+    def queue_search(self, race, instance):
         esc_query = GLib.uri_escape_string(self.query, None, None)
-        uri = f"{self.this_instance}/api/v1/search?q={esc_query};page={page};type=all;fields=type,title,videoId,playlistId,author,lengthSeconds,videoThumbnails,videoCount,videos"
+        uri = f"{instance}/api/v1/search?q={esc_query};page={race['page']};type=all;fields={self.search_fields}"
         #print(uri)
 
-        self.session = Soup.Session.new()
-        self.session.set_property("timeout", 5)
-        message = Soup.Message.new("GET", uri)
-        self.session.queue_message(message, self.show_results, page)
+        race['tried'].append(instance)
+        race['messages'][instance] = self.queue("GET", uri,
+            self.show_results, (race, instance), priority = race['priority'])
+
+    def set_page_priority(self, page, priority):
+        # e.g. a prefetched page the user is now waiting on
+        race = self.races.get(page)
+        if race:
+            race['priority'] = priority
+            for message in race['messages'].values():
+                self.client.set_priority(message, priority)
+
+    def normalize_query(self, query):
+        # same query regardless of case and spacing
+        return " ".join(query.split()).casefold()
+
+    def get_cache_key(self, page):
+        return f"{self.normalize_query(self.query)}|{page}|{self.search_fields}"
+
+    def do_suggestions(self, query, suggestions_fetched):
+        # suggestions_fetched(query, suggestions) is called with the
+        # list of suggested queries, previously typed prefixes are
+        # served from the suggestions cache (backspacing is free)
+        self.use_best_instance()
+        cache_key = self.normalize_query(query)
+        cached = self.app_window.suggestions_cache.get(cache_key)
+        if cached:
+            self.submit(self.decode_suggestions, (cached['body'],),
+                self.suggestions_decoded, (query, suggestions_fetched))
+            return
+
+        esc_query = GLib.uri_escape_string(query, None, None)
+        uri = f"{self.this_instance}/api/v1/search/suggestions?q={esc_query}"
+        self.queue("GET", uri, self.show_suggestions,
+            (query, cache_key, suggestions_fetched), timeout = 2)
+
+    def show_suggestions(self, session, results, request):
+        query, cache_key, suggestions_fetched = request
+        if results.status_code != 200:
+            return False
+
+        body = results.response_body.data
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        self.app_window.suggestions_cache.put(cache_key, self.this_instance, body)
+
+        self.submit(self.decode_suggestions, (body,),
+            self.suggestions_decoded, (query, suggestions_fetched))
+
+    # runs on the worker thread
+    def decode_suggestions(self, body):
+        return json.loads(body).get('suggestions', [])
+
+    def suggestions_decoded(self, suggestions, request):
+        query, suggestions_fetched = request
+        if suggestions is not None:
+            suggestions_fetched(query, suggestions)
+        return False
+
+    def hedge_search(self, race):
+        # send the same page to the next fastest instance
+        race['hedge_id'] = 0
+        if not race['won'] and not self.cancelled:
+            next_instance = self.strong_instances.next_instance(race['tried'])
+            if next_instance:
+                self.queue_search(race, next_instance)
+        return False
+
+    def retry_search(self, race):
+        # try the page again on the next healthy instance
+        if len(race['tried']) >= self.max_attempts:
+            return False
+
+        next_instance = self.strong_instances.next_instance(race['tried'])
+        if not next_instance:
+            return False
+
+        self.queue_search(race, next_instance)
+        return True
+
+    def finish_race(self, race):
+        race['won'] = True
+        if race['hedge_id']:
+            GLib.source_remove(race['hedge_id'])
+            race['hedge_id'] = 0
+
+        # cancel the losing requests, their callbacks see the race is won
+        messages = list(race['messages'].values())
+        race['messages'] = {}
+        for message in messages:
+            self.client.cancel(message, self)
 
     def do_single_video_search(self, video_id):
+        self.use_best_instance()
         esc_video_id = GLib.uri_escape_string(video_id, None, None)
         uri = f"{self.this_instance}/api/v1/videos/{video_id}?fields=title,videoId,author,lengthSeconds,videoThumbnails"
 
-        self.session = Soup.Session.new()
-        self.session.set_property("timeout", 5)
-        message = Soup.Message.new("GET", uri)
-        self.session.queue_message(message, self.show_single_result)
+        self.queue("GET", uri, self.show_single_result, self.this_instance)
+
+    def show_results(self, session, results, request):
+        race, instance = request
+        race['messages'].pop(instance, None)
+        if race['won']:
+            # a hedged request already answered this page
+            return False
 
-    def show_results(self, session, results, page):
+        page = race['page']
         if results.status_code != 200:
+            # wait for the hedged request still out, or fail over
+            if race['messages'] or race['decoding'] or self.retry_search(race):
+                return False
+
             if page == 1:
                 self.app_window.show_error_box("Service Failure",
                     "There is no response from the streaming servers.")
+            return self.search_done(page, instance, None, race['page_fetched'])
+
+        # the race is decided once the page decodes
+        body = results.response_body.data
+        race['decoding'] += 1
+        self.submit(self.decode_search_page, (body, instance),
+            self.search_page_decoded, (race, instance, body))
+
+    def search_page_decoded(self, search_json, request):
+        race, instance, body = request
+        race['decoding'] -= 1
+        if race['won']:
             return False
 
-        try:
-            self.search_json = json.loads(results.response_body.data)
-        except:
+        page = race['page']
+        if search_json is None:
+            if race['messages'] or race['decoding'] or self.retry_search(race):
+                return False
+
             if page == 1:
                 self.app_window.show_error_box("Service Failure",
                     "The streaming server response failed to parse results.")
-            return False
-
+            return self.search_done(page, instance, None, race['page_fetched'])
+
+        self.finish_race(race)
+
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        self.app_window.search_cache.put(self.get_cache_key(page), instance, body)
+
+        return self.search_done(page, instance, search_json, race['page_fetched'])
+
+    # runs on the worker thread
+    def decode_search_page(self, body, instance):
+        # shape the page into the result records that are shown
+        results = []
+        for meta in json.loads(body):
+            if meta['type'] == 'video':
+                self.set_poster_uri(meta, meta, instance)
+                results.append(meta)
+            elif meta['type'] == 'playlist':
+                if meta.get('videos'):
+                    self.set_poster_uri(meta['videos'][0], meta, instance)
+                    # only the first video was needed, for the poster
+                    del meta['videos']
+                    results.append(meta)
+#            elif meta['type'] == 'channel':
+#                print('channel')
+        return results
+
+    def search_done(self, page, instance, search_json, page_fetched):
+        self.races.pop(page, None)
+        if page_fetched:
+            page_fetched(page, instance, search_json)
+        elif search_json is not None:
+            self.show_page(instance, search_json)
+        return False
+
+    def show_page(self, instance, search_json):
+        # results (and their relative poster urls) belong to this instance
+        self.this_instance = instance
+        self.search_json = search_json
         for meta in self.search_json:
             self.process_meta(meta)
 
-    def show_single_result(self, session, results):
+    def show_single_result(self, session, results, instance):
         if results.status_code != 200:
             return False
 
-        try:
-            meta = json.loads(results.response_body.data)
-        except:
-            return False
+        self.submit(self.decode_single_video,
+            (results.response_body.data, instance),
+            self.single_video_decoded, instance)
 
+    # runs on the worker thread
+    def decode_single_video(self, body, instance):
+        meta = json.loads(body)
         if meta:
             meta['type'] = 'video'
+            self.set_poster_uri(meta, meta, instance)
+        return meta
+
+    def single_video_decoded(self, meta, instance):
+        if meta:
+            self.this_instance = instance
             self.process_meta(meta)
+        return False
 
     def process_meta(self, meta):
         if meta['type'] == 'video':
             if meta['videoId'] not in self.search_video_ids:
-                video_meta = meta
-                self.get_poster_url(video_meta, meta)
-                self.get_video_details(meta)
+                self.add_video(meta)
         elif meta['type'] == 'playlist':
             if meta['playlistId'] not in self.search_playlist_ids:
-                if 'videos' in meta:
-                    first_video_meta = meta['videos'][0]
-                    self.get_poster_url(first_video_meta, meta)
-                    self.append_playlist(meta)
-#        elif meta['type'] == 'channel':
-#            print('channel')
+                self.append_playlist(meta)
 
     def do_playlist(self, playlist_id, page):
         self.toggle_status_spinner(True)
+        self.use_best_instance()
         #/api/v1/playlists/:plid
         uri = f"{self.this_instance}/api/v1/playlists/{playlist_id}?page={page};fields=videos"
         #print(uri)
 
-        self.session = Soup.Session.new()
-        self.session.set_property("timeout", 5)
-        message = Soup.Message.new("GET", uri)
-        self.session.queue_message(message, self.show_playlist_results, page)
+        self.queue("GET", uri, self.show_playlist_results, page)
 
     def show_playlist_results(self, session, results, page):
         if results.status_code != 200:
@@ -122,84 +382,153 @@ class Search:
                     "There is no response from the streaming servers.")
             return False
 
-        try:
-            self.search_json = json.loads(results.response_body.data)
-        except:
+        self.submit(self.decode_playlist_page,
+            (results.response_body.data, self.this_instance),
+            self.playlist_page_decoded, page)
+
+    # runs on the worker thread
+    def decode_playlist_page(self, body, instance):
+        videos = json.loads(body).get('videos', [])
+        for meta in videos:
+            meta['type'] = 'video'
+            self.set_poster_uri(meta, meta, instance)
+        return videos
+
+    def playlist_page_decoded(self, videos, page):
+        if videos is None:
             if page == 1:
                 self.app_window.show_error_box("Service Failure",
                     "The streaming server response failed to parse results.")
             return False
 
-        if 'videos' in self.search_json:
-            for meta in self.search_json['videos']:
-                meta['type'] = 'video'
-                video_meta = meta
-                self.get_poster_url(video_meta, meta)
-                self.get_video_details(meta)
-
-    def get_poster_url(self, meta, append_meta):
+        for meta in videos:
+            self.add_video(meta)
+        return False
+
+    def add_video(self, video_meta):
+        if not self.app_window.settings.get_boolean('lazy-stream-resolution'):
+            self.get_video_details(video_meta)
+            return
+
+        # show the result from search meta alone, the streams are
+        # resolved (see resolve_video) once the result is played,
+        # focused or scrolled into view
+        video_meta['instance'] = self.this_instance
+        self.add_result_meta(video_meta)
+        self.search_video_ids.append(video_meta['videoId'])
+        self.toggle_status_spinner(False)
+
+    def resolve_video(self, video_meta):
+        # resolve stream urls and check they are playable,
+        # add_result_meta is called with the resolved meta
+        video_meta.pop('tried_instances', None)
+        # start on the currently best ranked instance, the one the
+        # meta came from may be slow or gone by now (e.g. history)
+        self.use_best_instance()
+        video_meta['instance'] = self.this_instance
+        self.get_video_details(video_meta)
+
+    def set_poster_uri(self, meta, append_meta, instance):
+        # every 16:9 rendition by width, the 4:3 ones are letterboxed
+        poster_uris = {}
         for poster in meta['videoThumbnails']:
+            if poster['url'].startswith('/'):
+                poster_uri = f"{instance}{poster['url']}"
+            else:
+                poster_uri = poster['url']
+
             if poster['quality'] == 'medium':
-                if poster['url'].startswith('/'):
-                    append_meta['poster_uri'] = f"{self.this_instance}{poster['url']}"
-                else:
-                    append_meta['poster_uri'] = poster['url']
+                append_meta['poster_uri'] = poster_uri
+
+            width = poster.get('width') or 0
+            height = poster.get('height') or 0
+            if height and abs(width / height - 16 / 9) < 0.05:
+                poster_uris.setdefault(width, poster_uri)
+        append_meta['poster_uris'] = sorted(poster_uris.items())
 
     def get_video_details(self, video_meta):
+        # each video is routed on its own, a failure
+        # only moves this video to another instance
+        instance = video_meta.setdefault('instance', self.this_instance)
         video_id = video_meta['videoId']
-        uri = f"{self.this_instance}/api/v1/videos/{video_id}?fields=adaptiveFormats,formatStreams"
-        self.session = Soup.Session.new()
-        self.session.set_property("timeout", 5)
-        message = Soup.Message.new("GET", uri)
-        self.session.queue_message(message, self.parse_video_results, video_meta)
+        uri = f"{instance}/api/v1/videos/{video_id}?fields=adaptiveFormats,formatStreams"
+        self.queue("GET", uri, self.parse_video_results, video_meta)
 
     def parse_video_results(self, session, results, video_meta):
         if results.status_code != 200:
             # remove unplayable video urls from list
-            return False
-
-        try:
-            self.video_json = json.loads(results.response_body.data)
-        except:
-            return False
-
-        video_meta['video_uri'] = None
-        for format_stream in self.video_json['formatStreams']:
-
-            if format_stream['qualityLabel'] == "360p":
-                video_meta['video_uri'] = format_stream['url']
-
-            # if (future) user-config desires 720p,
-            # check if it is available and if so use it instead
-            #if format_stream['qualityLabel'] == "720p":
-            #    self.video_uri = format_stream['url']
-
+            return self.failover_video(video_meta)
+
+        self.submit(self.decode_video_streams,
+            (results.response_body.data, self.get_format_selector()),
+            self.video_streams_decoded, video_meta)
+
+    def get_format_selector(self):
+        # the measured bandwidth and the user's quality cap, read
+        # here since the selector itself runs on the worker thread
+        return quality.FormatSelector(
+            bandwidth = quality.get_default().get_estimate(),
+            max_height = quality.get_max_height(self.app_window.settings))
+
+    # runs on the worker thread
+    def decode_video_streams(self, body, selector):
+        video_json = json.loads(body)
+
+        # playback uses the muxed streams, the best that fits the link
+        streams = { 'video_uri': None }
+        format_stream = selector.pick_video(video_json['formatStreams'])
+        if format_stream:
+            streams['video_uri'] = format_stream['url']
+
+        self.get_adaptive_formats(video_json, streams, selector)
+        self.get_download_uris(video_json, streams, selector)
+        return streams
+
+    def get_adaptive_formats(self, video_json, video_meta, selector):
+        # separate h264 video renditions and one audio rendition,
+        # ResultsBox switches between the renditions while playing
+        adaptive_formats = video_json['adaptiveFormats']
+        video_meta['adaptive_video'] = [
+            { 'url': fmt['url'],
+              'type': fmt['type'],
+              'bitrate': fmt.get('bitrate'),
+              'qualityLabel': fmt.get('qualityLabel') }
+            for fmt in selector.get_video_formats(adaptive_formats, codec = 'avc1')]
+
+        audio_format = selector.pick_best_audio(adaptive_formats)
+        video_meta['adaptive_audio'] = None
+        if audio_format:
+            video_meta['adaptive_audio'] = { 'url': audio_format['url'],
+                                             'type': audio_format['type'],
+                                             'bitrate': audio_format.get('bitrate') }
+
+    def video_streams_decoded(self, streams, video_meta):
+        if streams is None:
+            return self.failover_video(video_meta)
+
+        video_meta.update(streams)
         if not video_meta['video_uri']:
+            if self.video_unplayable:
+                self.video_unplayable(video_meta)
             return False
 
         self.check_video_playable(video_meta)
-        self.get_download_uris(video_meta)
+        return False
 
     def check_video_playable(self, video_meta):
         video_uri = video_meta['video_uri']
-        session = Soup.Session.new()
-        session.set_property("timeout", 2)
-        message = Soup.Message.new("HEAD", video_uri)
-        session.queue_message(message, self.check_video_playable_cb, video_meta)
+        self.queue("HEAD", video_uri, self.check_video_playable_cb,
+            video_meta, timeout = 2)
 
     def check_video_playable_cb(self, session, results, video_meta):
         if results.status_code != 200:
             #print('Unplayable video file, trying next instance')
             #print(video_meta['title'])
             video_meta.pop('video_uri')
-            self.si_index += 1
-            if len(self.app_window.strong_instances) > self.si_index:
-                self.this_instance = self.app_window.strong_instances[self.si_index]
-                #print(self.this_instance)
-                self.get_video_details(video_meta)
-            else:
-                #print("Out of instances, breaking")
-                return False
+            self.strong_instances.record_failure(video_meta['instance'])
+            return self.failover_video(video_meta)
+
+        self.strong_instances.record_success(video_meta['instance'])
 
         if 'video_uri' in video_meta:
             # add the result to the video meta
@@ -211,6 +540,23 @@ class Search:
 
             self.toggle_status_spinner(False)
 
+    def failover_video(self, video_meta):
+        tried = video_meta.setdefault('tried_instances', [])
+        tried.append(video_meta['instance'])
+        next_instance = None
+        if len(tried) < self.max_attempts:
+            next_instance = self.strong_instances.next_instance(tried)
+
+        if not next_instance:
+            #print("Out of instances, breaking")
+            if self.video_unplayable:
+                self.video_unplayable(video_meta)
+            return False
+
+        video_meta['instance'] = next_instance
+        self.get_video_details(video_meta)
+        return False
+
     def append_playlist(self, playlist_meta):
         # add the playlist to the list
         # which will trigger the playlist to display to the user
@@ -219,9 +565,7 @@ class Search:
         # appending known playable playlists to filter duplicates
         self.search_playlist_ids.append(playlist_meta['playlistId'])
 
-    def get_download_uris(self, video_meta):
-        # get download link urls based on (future) user-config
-        # video quality: ["480p", "720p", "1080p"] # default 720p
+    def get_download_uris(self, video_json, video_meta, selector):
         # audio structure:
         #     "bitrate": "142028",
         #     "type": "audio/webm; codecs=\"opus\"",
@@ -232,30 +576,10 @@ class Search:
         #     "container": "mp4",
         #     "qualityLabel": "720p"
 
-        last_bitrate = None
-        video_meta['audio_dl_uri'] = None
-        for af in self.video_json['adaptiveFormats']:
-            if af['type'].startswith('audio/mp4'):
-                if not video_meta['audio_dl_uri']:
-                    last_bitrate = af['bitrate']
-                    video_meta['audio_dl_uri'] = af['url']
-
-                if af['bitrate'] > last_bitrate:
-                    last_bitrate = af['bitrate']
-                    video_meta['audio_dl_uri'] = af['url']
-
-        video_quality = "720p"
-        video_meta['video_dl_uri'] = None
-        for fs in self.video_json['formatStreams']:
-            if fs['type'].startswith('video/mp4'):
-                # set it to something
-                if not video_meta['video_dl_uri']:
-                    video_meta['video_dl_uri'] = fs['url']
-
-                if 'qualityLabel' in fs:
-                    if fs['qualityLabel'] == "720p" and video_quality == "720p":
-                        video_meta['video_dl_uri'] = fs['url']
-                    elif fs['qualityLabel'] == "480p" and video_quality == "480p":
-                        video_meta['video_dl_uri'] = fs['url']
-                    elif fs['qualityLabel'] == "1080p" and video_quality == "1080p":
-                        video_meta['video_dl_uri'] = fs['url']
+        # downloads take the best quality within the cap,
+        # a slow link only makes them take longer
+        audio_format = selector.pick_best_audio(video_json['adaptiveFormats'])
+        video_meta['audio_dl_uri'] = audio_format['url'] if audio_format else None
+
+        video_format = selector.pick_best_video(video_json['formatStreams'])
+        video_meta['video_dl_uri'] = video_format['url'] if video_format else None
@@ -0,0 +1,128 @@
+# videostore.py
+#
+# Copyright 2021 Purism, SPC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib
+
+from urllib.parse import urlparse, parse_qs
+import json
+
+class VideoStore:
+
+    # meta kept for a played video
+    meta_keys = [ 'videoId', 'title', 'author', 'lengthSeconds',
+                  'videoThumbnails', 'poster_uri', 'poster_uris' ]
+    # resolved stream urls, only reused until they expire
+    stream_keys = [ 'video_uri', 'audio_dl_uri', 'video_dl_uri',
+                    'adaptive_video', 'adaptive_audio' ]
+
+    # videos kept, least recently played are dropped first
+    max_entries = 100
+    # seconds before expiry a stream url is no longer reused
+    expire_margin = 60 * 5
+
+    def __init__(self, **kwargs):
+        self.store_file = kwargs.get('store_file', None)
+
+        # videoId -> meta, least recently played first
+        self.store_json = { 'videos': {} }
+        self.write_id = 0
+        self.get_store_json()
+
+    def get_store_json(self):
+        try:
+            with open(self.store_file) as file:
+                store_json = json.load(file)
+        except:
+            return False
+
+        # an older format or a partial write keeps the empty default
+        if not isinstance(store_json, dict) or not isinstance(store_json.get('videos'), dict):
+            return False
+
+        # results are set up from these, entries without them are dropped
+        entry_keys = [ 'videoId', 'title', 'author', 'lengthSeconds', 'poster_uri' ]
+        store_json['videos'] = { video_id: entry for video_id, entry
+                                 in store_json['videos'].items()
+                                 if isinstance(entry, dict) and
+                                 all(key in entry for key in entry_keys) }
+        self.store_json = store_json
+        return True
+
+    def write_store_json(self):
+        self.write_id = 0
+        try:
+            with open(self.store_file, 'w') as file:
+                json.dump(self.store_json, file)
+        except:
+            pass
+        return False
+
+    def queue_write(self):
+        if not self.write_id:
+            self.write_id = GLib.timeout_add_seconds(1, self.write_store_json)
+
+    def get_expire(self, uri):
+        # googlevideo urls carry their expiry (unix time) in the query
+        try:
+            expire = parse_qs(urlparse(uri).query).get('expire')
+            if expire:
+                return int(expire[0])
+        except:
+            pass
+        return None
+
+    def put(self, video_meta):
+        entry = {}
+        for key in self.meta_keys:
+            if key in video_meta:
+                entry[key] = video_meta[key]
+
+        if video_meta.get('video_uri'):
+            for key in self.stream_keys:
+                if key in video_meta:
+                    entry[key] = video_meta[key]
+            entry['expire'] = self.get_expire(video_meta['video_uri'])
+
+        videos = self.store_json['videos']
+        videos.pop(video_meta['videoId'], None)
+        videos[video_meta['videoId']] = entry
+        while len(videos) > self.max_entries:
+            del videos[next(iter(videos))]
+
+        self.queue_write()
+
+    def get(self, video_id):
+        entry = self.store_json['videos'].get(video_id)
+        if not entry:
+            return None
+
+        video_meta = dict(entry)
+        video_meta['type'] = 'video'
+
+        # drop stream urls that expired (or never said when they do),
+        # they are resolved again when the video is played
+        now = GLib.get_real_time() / GLib.USEC_PER_SEC
+        expire = video_meta.pop('expire', None)
+        if not expire or expire - self.expire_margin <= now:
+            for key in self.stream_keys:
+                video_meta.pop(key, None)
+
+        return video_meta
+
+    def remove(self, video_id):
+        if self.store_json['videos'].pop(video_id, None):
+            self.queue_write()
@@ -0,0 +1,163 @@
+# virtuallist.py
+#
+# Copyright 2021 Purism, SPC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gio, Gtk
+
+from .results import ResultsBox
+
+class VirtualList:
+
+    # every result is a light FlowBoxChild slot holding its meta,
+    # only slots near the viewport get a ResultsBox, the others are
+    # kept at the height of a row so scrolling does not jump.
+    # ResultsBoxes leaving the viewport are reset and reused.
+
+    # pixels beyond the visible area where rows are realized
+    realize_margin = 1200
+    # unbound ResultsBoxes kept for reuse, the rest are destroyed
+    max_spare = 6
+    # height of the title and channel below the poster, used to
+    # guess the row height before a row was measured
+    details_height = 100
+
+    def __init__(self, app_window, flowbox):
+        self.app_window = app_window
+        self.flowbox = flowbox
+
+        # result meta (the compact store), in row order
+        self.metas = []
+        # FlowBoxChild per row, same order as metas
+        self.slots = []
+        # slot -> ResultsBox realized in it
+        self.bound = {}
+        # reset ResultsBoxes ready to be bound again
+        self.spare = []
+        # measured height of a realized row
+        self.row_height = None
+
+    def __len__(self):
+        return len(self.metas)
+
+    def get_row_height(self):
+        if self.row_height:
+            return self.row_height
+        video_height = int(self.app_window.video_size_active / 1.77)
+        return video_height + self.details_height
+
+    def append(self, meta):
+        slot = Gtk.FlowBoxChild()
+        slot.set_size_request(-1, self.get_row_height())
+        slot.result_meta = meta
+        slot.show()
+
+        self.metas.append(meta)
+        self.slots.append(slot)
+        self.flowbox.add(slot)
+
+    def remove(self, slot):
+        if slot not in self.slots:
+            return False
+
+        index = self.slots.index(slot)
+        del self.slots[index]
+        del self.metas[index]
+        self.unbind(slot, force = True)
+        slot.destroy()
+
+    def remove_result(self, results_box):
+        for slot, bound_box in self.bound.items():
+            if bound_box is results_box:
+                return self.remove(slot)
+
+    def clear(self):
+        for slot in list(self.bound):
+            self.unbind(slot, force = True)
+        for slot in self.slots:
+            slot.destroy()
+        self.metas = []
+        self.slots = []
+
+    def is_near(self, slot):
+        return self.app_window.is_result_visible(slot, self.realize_margin)
+
+    def update(self):
+        # bind rows that came near the viewport, recycle the rest
+        row_height = self.get_row_height()
+        for slot in self.slots:
+            if slot in self.bound:
+                if not self.is_near(slot):
+                    self.unbind(slot)
+            elif self.is_near(slot):
+                self.bind(slot)
+            elif slot.get_size_request()[1] != row_height:
+                slot.set_size_request(-1, row_height)
+
+    def bind(self, slot):
+        if self.spare:
+            results_box = self.spare.pop()
+        else:
+            results_box = ResultsBox(self.app_window)
+
+        # the realized row sizes the slot
+        slot.set_size_request(-1, -1)
+        slot.add(results_box)
+        results_box.show()
+        results_box.setup_stream(slot.result_meta)
+        self.bound[slot] = results_box
+
+    def unbind(self, slot, force = False):
+        results_box = self.bound.get(slot)
+        if not results_box:
+            return False
+
+        if not force and results_box.is_busy():
+            # playing or downloading, keep it
+            return False
+
+        height = slot.get_allocated_height()
+        if height > 1:
+            self.row_height = height
+        slot.set_size_request(-1, self.get_row_height())
+
+        busy = results_box.is_busy()
+        del self.bound[slot]
+        slot.remove(results_box)
+        results_box.reset()
+        if not busy and len(self.spare) < self.max_spare:
+            self.spare.append(results_box)
+        else:
+            results_box.destroy()
+
+    def trim(self, level):
+        # low memory, posters off screen are dropped, and so are the
+        # spare boxes when it is critical
+        for results_box in self.bound.values():
+            results_box.trim_poster()
+        if level >= Gio.MemoryMonitorWarningLevel.CRITICAL:
+            for results_box in self.spare:
+                results_box.destroy()
+            self.spare = []
+
+    def resize(self):
+        # rows change height with the video size, measure again
+        self.row_height = None
+        for results_box in self.bound.values():
+            results_box.resize_results()
+        for results_box in self.spare:
+            results_box.set_player_box_size()
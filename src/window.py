@@ -19,14 +19,21 @@ import gi
 gi.require_version('Gdk', '3.0')
 gi.require_version('Gtk', '3.0')
 gi.require_version('Handy', '1')
-from gi.repository import Gdk, GLib, Gtk, Handy
+from gi.repository import Gdk, Gio, GLib, Gtk, Handy
 
 Handy.init()
 
 from .menu import Menu
 from .history import HistoryBox
-from .results import ResultsBox
 from .instances import Instances
+from .pool import InstancePool
+from .cache import ResponseCache
+from .posters import PosterCache
+from .videostore import VideoStore
+from .pager import Pager
+from .players import PlayerPool
+from .virtuallist import VirtualList
+from . import client
 
 import json
 
@@ -42,6 +49,7 @@ class StreamWindow(Handy.ApplicationWindow):
     osd_label = Gtk.Template.Child()
 
     user_data_dir = GLib.get_user_data_dir()
+    user_cache_dir = GLib.get_user_cache_dir()
     header_bar = Gtk.Template.Child()
     status_icon = Gtk.Template.Child()
 
@@ -68,6 +76,9 @@ class StreamWindow(Handy.ApplicationWindow):
     history_json = { 'search_history': [],
                      'videos_history': [] }
 
+    # meta of played videos, so history renders without network
+    videos_file = f"{user_data_dir}/videos.json"
+
     search_history_list = Gtk.Template.Child()
     videos_history_list = Gtk.Template.Child()
 
@@ -94,24 +105,95 @@ class StreamWindow(Handy.ApplicationWindow):
     video_size_active = video_small_width
     window_last_size = 'big'
 
+    # pixels beyond the visible area where results count as in view
+    visible_margin = 200
+    # pixels from the end of the results where the next page is shown
+    load_more_distance = 1200
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.application = kwargs.get('application', None)
+        self.settings = Gio.Settings.new('sm.puri.Stream')
 
         self.is_playing = False
         self.is_fullscreen = False
         self.history_rendered = False
         self.inhibit_cookie = 0
-        self.strong_instances = []
-        self.results_meta = []
-        self.videos_history_results_meta = []
-        self.playlist_results_meta = []
+        # what plays is audio only (the setting may have changed since,
+        # or the stream had no audio rendition), see on_delete_event
+        self.playing_audio_only = False
+        # ranked by measured latency, fastest instance first
+        self.strong_instances = InstancePool()
+
+        search_cache_ttl = self.settings.get_uint('search-cache-ttl')
+        search_cache_dir = None
+        if search_cache_ttl and self.settings.get_boolean('search-cache-disk'):
+            search_cache_dir = f"{self.user_cache_dir}/search"
+        self.search_cache = ResponseCache(
+            ttl = search_cache_ttl,
+            disk_dir = search_cache_dir)
+        self.suggestions_cache = ResponseCache(max_entries = 256)
+
+        poster_cache_dir = None
+        if self.settings.get_uint('poster-cache-size'):
+            poster_cache_dir = f"{self.user_cache_dir}/posters"
+        self.poster_cache = PosterCache(
+            cache_dir = poster_cache_dir,
+            disk_max_bytes = self.settings.get_uint('poster-cache-size') * 1024 * 1024,
+            memory_max_bytes = self.settings.get_uint('poster-memory-size') * 1024 * 1024)
+        # pixels beyond the visible area where posters are decoded,
+        # further away only their compressed bytes are kept
+        self.poster_decode_margin = self.settings.get_uint('poster-decode-margin')
+
+        # drop decoded posters when the system runs low on memory
+        # (Gio.MemoryMonitor is only in GLib 2.64 and later)
+        self.memory_monitor = None
+        if hasattr(Gio, 'MemoryMonitor'):
+            self.memory_monitor = Gio.MemoryMonitor.dup_default()
+            self.memory_monitor.connect("low-memory-warning", self.on_low_memory)
+
+        self.video_store = VideoStore(store_file = self.videos_file)
+        # a couple of pipelines shared by all results
+        self.players = PlayerPool()
+        # result meta of each list, only rows near the viewport
+        # get a (recycled) ResultsBox
+        self.results_view = VirtualList(self, self.results_list)
+        self.playlist_view = VirtualList(self, self.playlist_list)
+        self.videos_history_view = VirtualList(self, self.videos_history_list)
+
         self.instances = Instances(app_window = self)
         self.instances.get_strong_instances()
+        self.instances.start_monitor()
+
+        # resolve streams of results as they scroll into view
+        self.visible_check_id = 0
+        for scroll_list in [self.results_list, self.playlist_list, self.videos_history_list]:
+            scrolled_window = scroll_list.get_ancestor(Gtk.ScrolledWindow)
+            scrolled_window.get_vadjustment().connect("value-changed",
+                self.queue_visible_check)
+
+        # show the next search page before the end is reached
+        self.pager = None
+        self.search = None
+        self.playlist_search = None
+        self.search_query = None
+
+        # search as you type
+        self.incremental_search_id = 0
+        self.suggestions_search = None
+        self.suggestions_store = Gtk.ListStore(str)
+        completion = Gtk.EntryCompletion(model = self.suggestions_store)
+        completion.set_text_column(0)
+        completion.connect("match-selected", self.suggestion_selected)
+        self.search_entry_box.set_completion(completion)
+        self.scroller.get_vadjustment().connect("value-changed", self.check_load_more)
 
         self.menu = Menu(app_window = self)
         self.menu_button.set_popover(self.menu)
 
+        # audio only playback may continue with the window closed
+        self.connect("delete-event", self.on_delete_event)
+
         provider = Gtk.CssProvider()
         provider.load_from_resource('/sm/puri/Stream/ui/stream.css')
         styleContext = Gtk.StyleContext()
@@ -134,6 +216,10 @@ class StreamWindow(Handy.ApplicationWindow):
     @Gtk.Template.Callback()
     def back_navigate(self, button):
         self.pause_all(None)
+        # leaving the playlist, stop loading it
+        if self.playlist_search:
+            self.playlist_search.cancel()
+            self.playlist_search = None
         # restore search visible
         self.search_bar_toggle.set_visible(True)
         self.search_bar_toggle.set_active(True)
@@ -149,34 +235,43 @@ class StreamWindow(Handy.ApplicationWindow):
     def clear_results(self, start_pos, end_pos, data):
         # only clear results on cleared search bar (or called directly)
         if end_pos == 0:
-            self.page_results = 1
-            self.results_meta = []
-            children = self.results_list.get_children()
-            for child in children:
-                child.destroy()
+            # abort everything the previous search still has running
+            if self.search:
+                self.search.cancel()
+                self.search = None
+            self.search_query = None
+            self.pager = None
+            self.results_view.clear()
 
             self.clear_error_box()
             self.main_stack.set_visible_child_name("status_page")
             self.clear_playlist(0, 0, None)
 
     def clear_playlist(self, start_pos, end_pos, data):
+        if self.playlist_search:
+            self.playlist_search.cancel()
+            self.playlist_search = None
         self.page_playlist = 1
-        self.playlist_results_meta = []
-        children = self.playlist_list.get_children()
-        for child in children:
-            child.destroy()
+        self.playlist_view.clear()
 
     @Gtk.Template.Callback()
     def search_entry(self, search_box):
+        if self.incremental_search_id:
+            GLib.source_remove(self.incremental_search_id)
+            self.incremental_search_id = 0
+
+        self.run_search(search_box.get_text())
+
+        # write search to history
+        self.write_search_history(self.search_query)
+
+    def run_search(self, query):
         self.clear_results(0, 0, None)
         self.clear_error_box()
         self.history_toggle_button.set_active(False)
         self.main_stack.set_visible_child_name("lists_stack")
 
-        self.search_query = search_box.get_text()
-
-        # write search to history
-        self.write_search_history(self.search_query)
+        self.search_query = query
 
         if not self.strong_instances:
             self.show_error_box("Service Failure",
@@ -186,7 +281,50 @@ class StreamWindow(Handy.ApplicationWindow):
             self.search = Search(app_window = self,
                 toggle_status_spinner = self.toggle_status_spinner,
                 add_result_meta = self.add_result_meta)
-            self.search.do_search(query = self.search_query, page = self.page_results)
+            self.pager = Pager(search = self.search, query = self.search_query)
+            self.pager.show_next()
+
+    @Gtk.Template.Callback()
+    def search_changed(self, search_box):
+        if not self.settings.get_boolean('search-as-you-type'):
+            return False
+
+        # wait for typing to pause, every keystroke restarts the wait
+        if self.incremental_search_id:
+            GLib.source_remove(self.incremental_search_id)
+        delay = self.settings.get_uint('search-as-you-type-delay')
+        self.incremental_search_id = GLib.timeout_add(delay, self.incremental_search)
+
+    def incremental_search(self):
+        self.incremental_search_id = 0
+
+        query = self.search_entry_box.get_text().strip()
+        if len(query) < 2 or not self.strong_instances:
+            return False
+
+        # only the latest keystroke's suggestions are wanted
+        if self.suggestions_search:
+            self.suggestions_search.cancel()
+        self.suggestions_search = Search(app_window = self,
+            toggle_status_spinner = self.toggle_status_spinner)
+        self.suggestions_search.do_suggestions(query, self.show_suggestions)
+
+        # run_search cancels the previous query's requests
+        if query != self.search_query:
+            self.run_search(query)
+
+        return False
+
+    def show_suggestions(self, query, suggestions):
+        self.suggestions_store.clear()
+        for suggestion in suggestions[:8]:
+            self.suggestions_store.append([suggestion])
+        self.search_entry_box.get_completion().complete()
+
+    def suggestion_selected(self, completion, model, tree_iter):
+        self.search_entry_box.set_text(model[tree_iter][0])
+        self.search_entry(self.search_entry_box)
+        return True
 
     def toggle_status_spinner(self, toggle):
         if toggle:
@@ -202,9 +340,6 @@ class StreamWindow(Handy.ApplicationWindow):
             self.main_stack.set_visible_child_name("lists_stack")
 
     def show_history_if_exists(self):
-        if not self.strong_instances:
-            return False
-
         # this is called both from script an toggle button
         # to avoid recursive calling, the script will
         # set the toggle active and then return here from
@@ -222,8 +357,7 @@ class StreamWindow(Handy.ApplicationWindow):
             for history_box in self.search_history_list:
                 history_box.destroy()
 
-            for history_box in self.videos_history_list:
-                history_box.destroy()
+            self.videos_history_view.clear()
 
             # show reverse sorted history of last 10 searches
             for history in list(reversed(self.history_json['search_history'][-10::])):
@@ -244,6 +378,16 @@ class StreamWindow(Handy.ApplicationWindow):
         history_box.search_term.set_tooltip_text(history_value)
 
     def add_videos_history_row(self, history_value):
+        # played videos render straight from the local store,
+        # their stream is resolved again when played
+        stored_meta = self.video_store.get(history_value)
+        if stored_meta:
+            self.add_videos_history_result_meta(stored_meta)
+            return
+
+        if not self.strong_instances:
+            return False
+
         # grab the meta from search
         single_video_search = Search(app_window = self,
             toggle_status_spinner = self.toggle_status_spinner,
@@ -261,12 +405,10 @@ class StreamWindow(Handy.ApplicationWindow):
 
     @Gtk.Template.Callback()
     def videos_history_clear_all(self, button):
-        children = self.videos_history_list.get_children()
-        for child in children:
-            if child:
-                history_child = child.get_child()
-                if history_child:
-                    history_child.videos_history_row_delete(None)
+        # rows out of view have no box, go by the meta
+        for meta in list(self.videos_history_view.metas):
+            self.videos_history_json_remove(meta['videoId'])
+        self.videos_history_view.clear()
 
     def get_history_json(self):
         try:
@@ -299,6 +441,7 @@ class StreamWindow(Handy.ApplicationWindow):
                 self.history_json['videos_history'].remove(history_value)
 
         self.write_history_json()
+        self.video_store.remove(history_value)
 
     def write_search_history(self, history_value):
         if not self.menu.incognito_mode.get_active():
@@ -307,61 +450,112 @@ class StreamWindow(Handy.ApplicationWindow):
             self.history_json['search_history'].append(history_value)
             self.write_history_json()
 
-    def write_videos_history(self, history_value):
+    def write_videos_history(self, history_value, video_meta = None):
         if not self.menu.incognito_mode.get_active():
             self.videos_history_json_remove(history_value)
             # append new history_value
             self.history_json['videos_history'].append(history_value)
             self.write_history_json()
 
+            if video_meta:
+                self.video_store.put(video_meta)
+
     def add_result_meta(self, meta):
         # stores an array of results for playlists and videos
-        self.results_meta.append(meta)
-        index_meta = len(self.results_meta) - 1
-        self.add_result(index_meta)
-
-    def add_result(self, index):
-        results_box = ResultsBox(self)
-        self.results_list.add(results_box)
-
-        meta = self.results_meta[index]
-        results_box.setup_stream(meta)
+        self.results_view.append(meta)
+        self.queue_visible_check(None)
 
     def add_videos_history_result_meta(self, meta):
-        self.videos_history_results_meta.append(meta)
-        index_meta = len(self.videos_history_results_meta) - 1
-        self.add_videos_history_result(index_meta)
-
-    def add_videos_history_result(self, index):
-        videos_history_result_box = ResultsBox(self)
-        self.videos_history_list.add(videos_history_result_box)
-
-        meta = self.videos_history_results_meta[index]
-        videos_history_result_box.setup_stream(meta)
+        self.videos_history_view.append(meta)
+        self.queue_visible_check(None)
 
     def add_playlist_result_meta(self, meta):
         # stores an array of results for playlists and videos
-        self.playlist_results_meta.append(meta)
-        index_playlist_meta = len(self.playlist_results_meta) - 1
-        self.add_playlist_result(index_playlist_meta)
+        self.playlist_view.append(meta)
+        self.queue_visible_check(None)
+
+    def queue_visible_check(self, adjustment):
+        # scrolling and new results come in bursts, check once they settle
+        if not self.visible_check_id:
+            self.visible_check_id = GLib.timeout_add(150, self.visible_check)
+
+    def is_result_visible(self, flowbox_child, margin):
+        scrolled_window = flowbox_child.get_ancestor(Gtk.ScrolledWindow)
+        if not scrolled_window or not flowbox_child.get_mapped():
+            return False
 
-    def add_playlist_result(self, index):
-        playlist_results_box = ResultsBox(self)
-        self.playlist_list.add(playlist_results_box)
+        coords = flowbox_child.translate_coordinates(scrolled_window, 0, 0)
+        if not coords:
+            return False
 
-        meta = self.playlist_results_meta[index]
-        playlist_results_box.setup_stream(meta)
+        y = coords[1]
+        height = flowbox_child.get_allocated_height()
+        view_height = scrolled_window.get_allocated_height()
+        return y + height >= -margin and y <= view_height + margin
+
+    def get_result_priority(self, flowbox_child):
+        if self.is_result_visible(flowbox_child, 0):
+            return client.PRIORITY_VISIBLE
+        if self.is_result_visible(flowbox_child, self.visible_margin):
+            return client.PRIORITY_NEAR
+        return client.PRIORITY_PREFETCH
+
+    def on_low_memory(self, monitor, level):
+        self.poster_cache.trim(level)
+        for view in [self.results_view, self.playlist_view, self.videos_history_view]:
+            view.trim(level)
+
+    def get_scroller_view(self):
+        scroller_list = self.get_scroller_list()
+        for view in [self.results_view, self.playlist_view, self.videos_history_view]:
+            if view.flowbox == scroller_list:
+                return view
+
+    def visible_check(self):
+        self.visible_check_id = 0
+        scroller_list = self.get_scroller_list()
+
+        # a short page may not fill the view, so nothing scrolls
+        if scroller_list == self.results_list:
+            self.check_load_more(None)
+
+        # realize the rows near the viewport, recycle the rest
+        self.get_scroller_view().update()
+
+        # re-rank every result so what is on screen is fetched first
+        for flowbox in scroller_list.get_children():
+            result_window = flowbox.get_child()
+            if not result_window:
+                continue
+
+            priority = self.get_result_priority(flowbox)
+            result_window.set_priority(priority)
+            result_window.set_poster_visible(
+                self.is_result_visible(flowbox, self.poster_decode_margin))
+
+            # history only goes to the network when a video is played
+            if (priority != client.PRIORITY_PREFETCH and
+                    scroller_list != self.videos_history_list):
+                result_window.resolve_stream()
+        return False
 
     @Gtk.Template.Callback()
     def load_more(self, event, data):
+        self.check_load_more(None)
+
+    def check_load_more(self, adjustment):
+        if not self.pager:
+            return False
+
         vadj = self.scroller.get_vadjustment()
         position = vadj.get_value()
         upper = vadj.get_upper()
         page_size = vadj.get_page_size()
 
-        if position + page_size >= upper:
-            self.page_results += 1
-            self.search.do_search(query = self.search_query, page = self.page_results)
+        # the pager keeps one request per page, so repeated
+        # calls while a page is on its way do nothing
+        if position + page_size >= upper - self.load_more_distance:
+            self.pager.show_next()
 
 #    @Gtk.Template.Callback()
 #    def load_more_playlist(self, event, data):
@@ -376,18 +570,27 @@ class StreamWindow(Handy.ApplicationWindow):
 #            self.playlist_search.do_playlist(playlist_id = self.playlist_id, page = self.page_playlist)
 #
     def fullscreen_toggle(self, focus_child):
+        result_window = focus_child.get_child()
+        if not result_window:
+            return False
+
         if self.is_fullscreen:
-            focus_child.get_child().unfullscreen_button(None)
+            result_window.unfullscreen_button(None)
         else:
-            focus_child.get_child().fullscreen_button(None)
+            result_window.fullscreen_button(None)
 
     def play_pause_toggle(self, focus_child):
+        result_window = focus_child.get_child()
+        if not result_window:
+            # scrolled far out of view, nothing realized to play
+            return False
+
         if self.is_playing:
             self.osd_display_show("media-playback-pause-symbolic", "Pause")
-            focus_child.get_child().pause_button(None)
+            result_window.pause_button(None)
         else:
             self.osd_display_show("media-playback-start-symbolic", "Play")
-            focus_child.get_child().play_button(None)
+            result_window.play_button(None)
 
 #    @Gtk.Template.Callback()
 #    def open_primary_menu(self, widget, ev):
@@ -401,6 +604,25 @@ class StreamWindow(Handy.ApplicationWindow):
         else:
             return self.results_list
 
+    def preroll_next(self, result_window):
+        # the result autoplay moves on to, ready on the spare player
+        stack = self.menu.mode_switcher.get_stack()
+        if not stack or stack.get_visible_child_name() != "auto":
+            return False
+
+        flowbox = result_window.get_parent()
+        if not isinstance(flowbox, Gtk.FlowBoxChild):
+            return False
+
+        # history only goes to the network when a video is played
+        list = flowbox.get_parent()
+        if list == self.videos_history_list:
+            return False
+
+        next_flowbox = list.get_child_at_index(flowbox.get_index() + 1)
+        if next_flowbox and next_flowbox.get_child():
+            next_flowbox.get_child().preroll()
+
     def next_playback_action(self):
         list = self.get_scroller_list()
         focus_child = list.get_focus_child()
@@ -425,7 +647,7 @@ class StreamWindow(Handy.ApplicationWindow):
     def keypress_listener(self, widget, ev):
         list = self.get_scroller_list()
         focus_child = list.get_focus_child()
-        if focus_child:
+        if focus_child and focus_child.get_child():
             # key values are from gdk/gdkkeysyms.h
             key = Gdk.keyval_name(ev.keyval)
             if key == "Escape":
@@ -478,15 +700,44 @@ class StreamWindow(Handy.ApplicationWindow):
                 if result_window and result_window != active_window:
                     result_window.null_out_player()
 
-    def inhibit_app(self):
-        self.inhibit_cookie = self.application.inhibit(self,
-                Gtk.ApplicationInhibitFlags.IDLE |
-                Gtk.ApplicationInhibitFlags.LOGOUT,
-                "Stream-ing Video")
+    def inhibit_app(self, audio_only = False):
+        self.playing_audio_only = audio_only
+        if audio_only:
+            # the screen may blank, the device must not suspend
+            self.inhibit_cookie = self.application.inhibit(self,
+                    Gtk.ApplicationInhibitFlags.SUSPEND |
+                    Gtk.ApplicationInhibitFlags.LOGOUT,
+                    "Stream-ing Audio")
+        else:
+            self.inhibit_cookie = self.application.inhibit(self,
+                    Gtk.ApplicationInhibitFlags.IDLE |
+                    Gtk.ApplicationInhibitFlags.LOGOUT,
+                    "Stream-ing Video")
 
     def uninhibit_app(self):
         if self.inhibit_cookie:
             self.application.uninhibit(self.inhibit_cookie)
+            self.inhibit_cookie = 0
+        self.playing_audio_only = False
+
+        # the window was closed while audio kept playing, quit
+        # unless playback goes on (autoplay starts the next video)
+        if not self.get_visible():
+            GLib.timeout_add_seconds(3, self.background_playback_check)
+
+    def background_playback_check(self):
+        if not self.is_playing and not self.get_visible():
+            self.destroy()
+        return False
+
+    def on_delete_event(self, window, event):
+        if (self.is_playing and self.playing_audio_only and
+                self.settings.get_boolean('audio-only-background')):
+            # hidden, the application keeps running with it and
+            # activating the application presents it again
+            self.hide()
+            return True
+        return False
 
     def clear_error_box(self):
         self.main_stack.set_visible_child_name("lists_stack")
@@ -503,7 +754,7 @@ class StreamWindow(Handy.ApplicationWindow):
     def reload_instances(self, event):
         self.status_icon.set_property('icon-name', 'content-loading-symbolic')
         self.clear_error_box()
-        self.instances.get_strong_instances()
+        self.instances.get_strong_instances(use_cache = False)
 
     @Gtk.Template.Callback()
     def swallow_fullscreen_scroll_event(self, event, data):
@@ -514,7 +765,7 @@ class StreamWindow(Handy.ApplicationWindow):
         # grab focus of playing video on keypress
         list = self.get_scroller_list()
         focus_child = list.get_focus_child()
-        if focus_child:
+        if focus_child and focus_child.get_child():
             focus_child.get_child().box_grab_focus()
 
     def mute_keypress(self):
@@ -577,9 +828,6 @@ class StreamWindow(Handy.ApplicationWindow):
                 trigger_resize = True
 
         if trigger_resize:
-            flowboxes = self.get_all_flowboxes()
-            for flowbox in flowboxes:
-                if flowbox:
-                    result_window = flowbox.get_child()
-                    if result_window:
-                        result_window.resize_results()
+            for view in [self.results_view, self.playlist_view, self.videos_history_view]:
+                view.resize()
+            self.queue_visible_check(None)
@@ -0,0 +1,56 @@
+# worker.py
+#
+# Copyright 2021 Purism, SPC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib
+
+import queue
+import threading
+
+class Worker:
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def submit(self, func, args, done_cb, user_data = None):
+        # func(*args) runs on the worker thread and must not touch
+        # any widget or Soup object, done_cb(result, user_data) then
+        # runs on the main loop. result is None if func raised.
+        self.jobs.put((func, args, done_cb, user_data))
+
+    def run(self):
+        while True:
+            func, args, done_cb, user_data = self.jobs.get()
+            try:
+                result = func(*args)
+            except:
+                result = None
+            GLib.idle_add(self.done_cb, done_cb, result, user_data)
+
+    def done_cb(self, done_cb, result, user_data):
+        done_cb(result, user_data)
+        return False
+
+# one worker thread per process
+default_worker = None
+
+def get_default():
+    global default_worker
+    if not default_worker:
+        default_worker = Worker()
+    return default_worker
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# instance_bench.py
+#
+# Copyright 2021 Purism, SPC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs the Instances probe pipeline against a local fleet of fake
+# Invidious instances and reports how it scales:
+#
+#   tools/instance_bench.py --instances 300 --error-rate 0.2
+#
+# Every fake instance listens on its own 127.0.0.1 port and has its
+# own latency, error rate and HEAD (video url) behavior.
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+class FleetStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.open_connections = 0
+        self.peak_connections = 0
+
+    def connection_opened(self):
+        with self.lock:
+            self.open_connections += 1
+            self.peak_connections = max(self.peak_connections, self.open_connections)
+
+    def connection_closed(self):
+        with self.lock:
+            self.open_connections -= 1
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+
+class FakeHandler(BaseHTTPRequestHandler):
+    # keep-alive, like a real instance
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.stats.connection_opened()
+
+    def finish(self):
+        super().finish()
+        self.server.stats.connection_closed()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.stats.request()
+        self.server.respond(self)
+
+    def do_HEAD(self):
+        self.server.stats.request()
+        self.server.respond(self)
+
+class FakeInstance(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, stats, latency, error_rate, head):
+        super().__init__(('127.0.0.1', 0), FakeHandler)
+        self.stats = stats
+        self.latency = latency
+        self.error_rate = error_rate
+        # 'ok', 'forbidden' or 'hang'
+        self.head = head
+
+        self.uri = f"http://127.0.0.1:{self.server_address[1]}"
+
+    def respond(self, handler):
+        time.sleep(self.latency)
+
+        if handler.path.startswith('/videoplayback'):
+            if self.head == 'ok':
+                handler.send_json(200, {})
+            elif self.head == 'forbidden':
+                handler.send_json(403, {})
+            else:
+                # longer than any probe timeout
+                time.sleep(10)
+                handler.send_json(200, {})
+            return
+
+        if random.random() < self.error_rate:
+            handler.send_json(500, { 'error': 'simulated failure' })
+        elif handler.path.startswith('/api/v1/search'):
+            handler.send_json(200, [ { 'type': 'video' } ])
+        elif handler.path.startswith('/api/v1/videos/'):
+            handler.send_json(200, { 'formatStreams': [
+                { 'type': 'video/mp4', 'url': f"{self.uri}/videoplayback" } ] })
+        else:
+            handler.send_json(404, { 'error': 'not found' })
+
+class FakeDirectory(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, stats, instances):
+        super().__init__(('127.0.0.1', 0), FakeHandler)
+        self.stats = stats
+        self.body = [ [f"fake-{i}", { 'uri': instance.uri }]
+                      for i, instance in enumerate(instances) ]
+
+        self.uri = f"http://127.0.0.1:{self.server_address[1]}/instances.json"
+
+    def respond(self, handler):
+        handler.send_json(200, self.body)
+
+def start_fleet(args, stats):
+    instances = []
+    for i in range(args.instances):
+        latency = random.uniform(args.latency_min, args.latency_max) / 1000
+        roll = random.random()
+        if roll < args.head_forbidden_rate:
+            head = 'forbidden'
+        elif roll < args.head_forbidden_rate + args.head_hang_rate:
+            head = 'hang'
+        else:
+            head = 'ok'
+        instances.append(FakeInstance(stats, latency, args.error_rate, head))
+
+    directory = FakeDirectory(stats, instances)
+
+    for server in instances + [directory]:
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+
+    return directory, instances
+
+class BenchWindow:
+    # stands in for StreamWindow, only what Instances touches
+
+    def __init__(self, pool):
+        self.strong_instances = pool
+        self.first_strong = None
+        self.errors = []
+        self.status_icon = self
+
+    def strong_instance_found(self):
+        if self.first_strong is None:
+            self.first_strong = time.monotonic()
+
+    def show_error_box(self, heading, text):
+        self.errors.append(f"{heading}: {text}")
+
+    def set_property(self, name, value):
+        pass
+
+def run_bench(args, directory):
+    from gi.repository import GLib
+
+    from src.instances import Instances
+    from src.pool import InstancePool
+
+    Instances.directory_uri = directory.uri
+    Instances.backup_instances = []
+    Instances.cache_file = os.path.join(tempfile.mkdtemp(), 'instances.json')
+    if args.concurrency:
+        Instances.probe_concurrency = args.concurrency
+    if args.target is not None:
+        Instances.probe_target = args.target
+
+    window = BenchWindow(InstancePool())
+    instances = Instances(app_window = window)
+
+    loop = GLib.MainLoop()
+    started = time.monotonic()
+    directory_done = []
+
+    def poll():
+        # done once the directory arrived and no probe is queued or running
+        if instances.probe_queue or instances.probe_messages:
+            directory_done.append(True)
+        elif directory_done or window.errors:
+            loop.quit()
+            return False
+
+        if time.monotonic() - started > args.timeout:
+            loop.quit()
+            return False
+        return True
+
+    instances.get_strong_instances(use_cache = False)
+    GLib.timeout_add(10, poll)
+    loop.run()
+
+    return window, started, time.monotonic()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark instance probing against a fake fleet")
+    parser.add_argument('--instances', type = int, default = 200)
+    parser.add_argument('--latency-min', type = float, default = 20, help = "ms")
+    parser.add_argument('--latency-max', type = float, default = 400, help = "ms")
+    parser.add_argument('--error-rate', type = float, default = 0.1)
+    parser.add_argument('--head-forbidden-rate', type = float, default = 0.2)
+    parser.add_argument('--head-hang-rate', type = float, default = 0.05)
+    parser.add_argument('--concurrency', type = int, default = None,
+                        help = "override Instances.probe_concurrency")
+    parser.add_argument('--target', type = int, default = None,
+                        help = "override Instances.probe_target, 0 probes everything")
+    parser.add_argument('--timeout', type = float, default = 60, help = "seconds")
+    parser.add_argument('--seed', type = int, default = 1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    stats = FleetStats()
+    directory, fleet = start_fleet(args, stats)
+
+    window, started, finished = run_bench(args, directory)
+
+    if window.errors:
+        print("\n".join(window.errors))
+    if window.first_strong is not None:
+        print(f"time to first strong instance: {window.first_strong - started:.3f} s")
+    else:
+        print("time to first strong instance: none found")
+    print(f"total probe time:              {finished - started:.3f} s")
+    print(f"strong instances:              {len(window.strong_instances)}")
+    print(f"total requests:                {stats.requests}")
+    print(f"peak open connections:         {stats.peak_connections}")
+
+if __name__ == '__main__':
+    main()